@@ -1,22 +1,78 @@
 
 
-from typing import TYPE_CHECKING, List, Optional
+from functools import wraps
+from typing import TYPE_CHECKING, Any, Callable, List, Optional, Tuple
 
+from .cache import ResultCache, copy_result
 from .db import CHDB
 
 if TYPE_CHECKING:
+    import numpy as np
     import pandas as pd
 
+    from .dataset import Dataset
+
+
+def _freeze(value: Any) -> Any:
+    """Hashable form of a method argument."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def cached(scope: Callable[..., str]) -> Callable:
+    """Cache the results of an API method in `API.cache`.
+
+    `scope` maps the method arguments to the generation key of the
+    data the result depends on (see `CHDB.generation`). The key is
+    part of the cache key, so a write to that data makes the cached
+    result unreachable. Every call returns its own copy of the result,
+    so callers may modify it.
+    """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return func(self, *args, **kwargs)
+            gen_key = scope(*args, **kwargs)
+            key = (func.__name__, _freeze(args),
+                   tuple(sorted((k, _freeze(v))
+                                for k, v in kwargs.items())),
+                   gen_key, self.db.generation(gen_key))
+            found, rv = self.cache.get(key)
+            if not found:
+                rv = func(self, *args, **kwargs)
+                self.cache.put(key, rv)
+            return copy_result(rv)
+        return wrapper
+    return decorator
+
+
+def _exp_scope(exp_id: int, *args, **kwargs) -> str:
+    return f'exp/{exp_id}'
+
+
+def _md_scope(*args, **kwargs) -> str:
+    return 'experiment_md'
+
 
 class API():
     def __init__(self,
                  dbfile: Optional[str] = None,
-                 read_only: bool = True) -> None:
+                 read_only: bool = True,
+                 cache_size: int = 256 * 1024**2) -> None:
+        """Query a cellhive database.
+
+        Results of the obs, obsm & datasets methods are kept in an
+        in-process cache of at most `cache_size` bytes (0 disables
+        it). Each call returns a copy of the cached result.
+        """
         self.dbfile = dbfile
         self.db = CHDB(dbfile=dbfile,
                        read_only=read_only)
+        self.cache = ResultCache(cache_size) if cache_size else None
 
-    def sql(self, sql: str):
+    def sql(self, sql: str, params=None, format: str = 'pandas'):
         """
         This method allows you to pass a SQL query (in the form of a string)
         to be executed against the underlying database. The results are
@@ -24,115 +80,451 @@ class API():
 
         Parameters:
         - sql (str): The SQL query to execute.
+        - params: Values for the `?` (a list) or `$name` (a dict)
+          placeholders in the query.
+        - format (str): 'pandas', 'arrow', 'numpy' or 'polars'.
 
         Returns:
-        - A pandas dataframe with the results from executing the SQL
-          statement on the database.
+        - The results from executing the SQL statement on the
+          database, by default as a pandas dataframe (see `CHDB.sql`).
         """
-        return self.db.sql(sql)
+        return self.db.sql(sql, params, format=format)
 
 
+    @cached(_exp_scope)
     def obsm_names(self, exp_id: int):
-        sql = f"""
+        sql = """
             SELECT DISTINCT name
-            FROM obs_num
-            WHERE exp_id = {exp_id}
-              AND name LIKE '%/0'
+            FROM obsm
+            WHERE exp_id = ?
         """
-        rv = self.db.sql(sql)
-        rv = [x.replace('/0', '') for x in rv['name']]
-        return rv
+        rv = self.db.sql(sql, [exp_id], format='numpy')
+        return list(rv['name'])
 
 
-    def obsm(self, exp_id: int, obsm_name: str):
-        sql = f"""
-            SELECT *
-            FROM obs_num
-            WHERE exp_id = {exp_id}
-              AND name LIKE '{obsm_name}/%'
+    @cached(_exp_scope)
+    def obsm(self, exp_id: int, obsm_name: str) -> "np.ndarray":
+        """Return an embedding as (cells x dims) float32 array.
+
+        Rows are in cell_id order (see `obs_dim`).
         """
-        rv = self.db.sql(sql)
-        rv = rv.pivot(index='cell', columns='name', values='value')
-        rv = rv.sort_index(axis=1, ascending=True)
-        return rv
+        import numpy as np
 
+        sql = """
+            SELECT coords
+            FROM obsm
+            WHERE exp_id = ?
+              AND name = ?
+            ORDER BY cell_id
+        """
+        coords = self.db.execute(
+            sql, [exp_id, obsm_name]).fetch_arrow_table()['coords']
+        if len(coords) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        coords = coords.combine_chunks()
+        n_dims = len(coords[0])
+        return coords.flatten().to_numpy().reshape(-1, n_dims)
 
-    def obs_num(self, exp_id: int, obs_names: List[str] | str):
 
+    @cached(_exp_scope)
+    def obs_index(self, exp_id: int) -> "pd.Index":
+        """Cell names of an experiment, in cell_id order."""
+        import pandas as pd
+
+        sql = """
+            SELECT obs
+            FROM obs_dim
+            WHERE exp_id = ?
+            ORDER BY cell_id
+        """
+        rv = self.db.execute(sql, [exp_id]).fetchnumpy()['obs']
+        return pd.Index(rv, name='cell')
+
+
+    def _obs_column(self, table: str, column: str,
+                    exp_id: int, name: str) -> "Tuple[np.ndarray, Any]":
+        """Cell ids & values (an Arrow array) of one obs column.
+
+        Rows are returned in storage order; callers scatter them by
+        cell_id, which is cheaper than sorting them in the database.
+        """
+        sql = f"""
+            SELECT cell_id, {column}
+            FROM {table}
+            WHERE exp_id = ?
+              AND name = ?
+        """
+        rv = self.db.execute(sql, [exp_id, name]).fetch_arrow_table()
+        return (rv.column('cell_id').to_numpy(),
+                rv.column(column).combine_chunks())
+
+
+    def _check_obs_names(self, obs_names: List[str] | str,
+                         known: Any) -> List[str]:
+        """Sorted obs column names, all of which must be known."""
         if isinstance(obs_names, str):
             obs_names = [obs_names]
+        missing = set(obs_names) - set(known)
+        if missing:
+            raise KeyError(f"Unknown obs columns: {', '.join(missing)}")
+        return sorted(set(obs_names))
 
-        inlist = ( "('"
-                   + "', '".join(obs_names)
-                   + "')" )
-        sql = f"""
-            SELECT *
-            FROM obs_num
-            WHERE exp_id = {exp_id}
-              AND name IN {inlist} """
-        rv = self.db.sql(sql)
-        rv = rv.pivot(index='cell', columns='name', values='value')
-        rv = rv.sort_index(axis=1, ascending=True)
+
+    @cached(_exp_scope)
+    def obs_num(self, exp_id: int, obs_names: List[str] | str):
+        """Numerical obs columns, as a dataframe indexed by cell.
+
+        Integer and boolean columns keep their (nullable) type and
+        width. Each column is fetched once and placed in a preallocated
+        array in cell_id order - no pivot or sort.
+        """
+        import numpy as np
+        import pandas as pd
+
+        obs_names = self._check_obs_names(
+            obs_names, self.obs_names_num(exp_id, format='numpy')['name'])
+        int_names = set(self.obs_names_int(exp_id, format='numpy')['name'])
+        bool_names = set(
+            self.obs_names_bool(exp_id, format='numpy')['name'])
+        int_dtypes = self.obs_int_dtypes(exp_id)
+
+        index = self.obs_index(exp_id)
+        rv = pd.DataFrame(index=index)
+        for name in obs_names:
+            if name in bool_names:
+                cell_ids, values = self._obs_column(
+                    'obs_bool', 'value', exp_id, name)
+                data = np.zeros(len(index), dtype=bool)
+                mask = np.ones(len(index), dtype=bool)
+                data[cell_ids] = values.fill_null(False).to_numpy(
+                    zero_copy_only=False)
+                mask[cell_ids] = values.is_null().to_numpy(
+                    zero_copy_only=False)
+                rv[name] = pd.arrays.BooleanArray(data, mask)
+            elif name in int_names:
+                cell_ids, values = self._obs_column(
+                    'obs_int', 'value', exp_id, name)
+                data = np.zeros(len(index),
+                                dtype=int_dtypes.get(name, 'int64'))
+                mask = np.ones(len(index), dtype=bool)
+                data[cell_ids] = values.fill_null(0).to_numpy()
+                mask[cell_ids] = values.is_null().to_numpy(
+                    zero_copy_only=False)
+                rv[name] = pd.arrays.IntegerArray(data, mask)
+            else:
+                cell_ids, values = self._obs_column(
+                    'obs_num', 'value', exp_id, name)
+                data = np.full(len(index), np.nan)
+                data[cell_ids] = values.to_numpy(zero_copy_only=False)
+                rv[name] = data
         return rv
 
-    def obs_names_num(self, exp_id: int):
-        sql = f"""
+    @cached(_exp_scope)
+    def obs_names_num(self, exp_id: int, format: str = 'pandas'):
+        sql = """
+            SELECT DISTINCT name FROM obs_num WHERE exp_id = $exp_id
+            UNION
+            SELECT DISTINCT name FROM obs_int WHERE exp_id = $exp_id """
+        if self.db.table_exists('obs_bool'):
+            sql += """
+            UNION
+            SELECT DISTINCT name FROM obs_bool WHERE exp_id = $exp_id """
+        rv = self.db.sql(sql, dict(exp_id=exp_id), format=format)
+        return rv
+
+    @cached(_exp_scope)
+    def obs_names_int(self, exp_id: int, format: str = 'pandas'):
+        sql = """
+            SELECT DISTINCT name
+            FROM obs_int
+            WHERE exp_id = ? """
+        rv = self.db.sql(sql, [exp_id], format=format)
+        return rv
+
+    @cached(_exp_scope)
+    def obs_names_bool(self, exp_id: int, format: str = 'pandas'):
+        if not self.db.table_exists('obs_bool'):
+            # written before boolean columns were kept
+            return self.db.sql("SELECT NULL::VARCHAR AS name WHERE false",
+                               format=format)
+        sql = """
             SELECT DISTINCT name
-            FROM obs_num
-            WHERE exp_id = {exp_id} """
-        rv = self.db.sql(sql)
+            FROM obs_bool
+            WHERE exp_id = ? """
+        rv = self.db.sql(sql, [exp_id], format=format)
         return rv
 
+    @cached(_exp_scope)
+    def obs_int_dtypes(self, exp_id: int) -> dict:
+        """NumPy dtype of each integer obs column (default int64)."""
+        if not self.db.table_exists('obs_dtype'):
+            return {}
+        rv = self.db.execute("""
+            SELECT name, dtype
+              FROM obs_dtype
+             WHERE exp_id = ?""", [exp_id]).fetchall()
+        return dict(rv)
+
 
 
+    @cached(_exp_scope)
     def obs_cat(self, exp_id: int, obs_names: List[str] | str):
+        """Categorical obs columns, as a dataframe indexed by cell.
 
-        if isinstance(obs_names, str):
-            obs_names = [obs_names]
+        Columns are `pd.Categorical`, built from the stored codes and
+        levels.
+        """
+        import numpy as np
+        import pandas as pd
 
-        inlist = ( "('"
-                   + "', '".join(obs_names)
-                   + "')" )
-        sql = f"""
-            SELECT *
-            FROM obs_cat
-            WHERE exp_id = {exp_id}
-              AND name IN {inlist} """
-        rv = self.db.sql(sql)
-        rv = rv.pivot(index='cell', columns='name', values='value')
-        rv = rv.sort_index(axis=1, ascending=True)
+        obs_names = self._check_obs_names(
+            obs_names, self.obs_names_cat(exp_id, format='numpy')['name'])
+
+        # the levels of all columns at once
+        levels = self.db.execute("""
+            SELECT name, level
+              FROM obs_cat_levels
+             WHERE exp_id = ?
+               AND list_contains(?, name)
+             ORDER BY name, code""", [exp_id, obs_names]).fetchnumpy()
+
+        index = self.obs_index(exp_id)
+        rv = pd.DataFrame(index=index)
+        for name in obs_names:
+            cell_ids, values = self._obs_column(
+                'obs_cat', 'code', exp_id, name)
+            codes = np.full(len(index), -1, dtype=np.int32)
+            codes[cell_ids] = values.fill_null(-1).to_numpy()
+            rv[name] = pd.Categorical.from_codes(
+                codes, categories=levels['level'][levels['name'] == name])
         return rv
 
 
-    def obs_names_cat(self, exp_id: int):
-        sql = f"""
+    @cached(_exp_scope)
+    def obs_names_cat(self, exp_id: int, format: str = 'pandas'):
+        sql = """
             SELECT DISTINCT name
             FROM obs_cat
-            WHERE exp_id = {exp_id} """
-        rv = self.db.sql(sql)
+            WHERE exp_id = ? """
+        rv = self.db.sql(sql, [exp_id], format=format)
         return rv
 
 
-    def datasets(self, query: str | None = None) -> "pd.DataFrame":
+    @cached(_md_scope)
+    def datasets(self, query: str | None = None,
+                 format: str = 'pandas') -> "pd.DataFrame":
         sql = """
             SELECT DISTINCT *
               FROM experiment_md """
+        params = None
         if query is not None:
-            sql += f"""
-             WHERE ( title ILIKE '%{query}%'
-                     OR author ILIKE  '%{query}%'
-                     OR abstract ILIKE '%{query}%' )
+            sql += """
+             WHERE ( title ILIKE $query
+                     OR author ILIKE $query
+                     OR abstract ILIKE $query )
             """
-        rv = self.db.sql(sql)
+            params = dict(query=f'%{query}%')
+        rv = self.db.sql(sql, params, format=format)
         return rv
 
 
-    def gene(self, dataset_id: int, gene: str) -> "pd.Series":
-        sql = f"""
-            SELECT obs, value
-              FROM expr
-            WHERE dataset_id = {dataset_id}
+    def n_cells(self, dataset_id: int) -> int:
+        """Number of cells of a dataset."""
+        rv = self.db.execute("""
+            SELECT n_cells FROM dataset_shape
+             WHERE dataset_id = ?""", [dataset_id]).fetchone()
+        if rv is None:
+            raise KeyError(f"Unknown dataset {dataset_id}")
+        return int(rv[0])
+
+
+    def n_genes(self, dataset_id: int) -> int:
+        """Number of genes of a dataset."""
+        rv = self.db.execute("""
+            SELECT n_genes FROM dataset_shape
+             WHERE dataset_id = ?""", [dataset_id]).fetchone()
+        if rv is None:
+            raise KeyError(f"Unknown dataset {dataset_id}")
+        return int(rv[0])
+
+
+    def exp_id(self, dataset_id: int) -> int:
+        """The experiment (obs & obsm) a dataset belongs to."""
+        rv = self.db.execute("""
+            SELECT full_experiment_id FROM experiment_md
+             WHERE dataset_id = ?""", [dataset_id]).fetchone()
+        if rv is None:
+            raise KeyError(f"Unknown dataset {dataset_id}")
+        return int(rv[0])
+
+
+    def gene(self, dataset_id: int, gene: str,
+             obsm: Optional[str] = None):
+        """Expression of one gene, as a float32 vector over all cells.
+
+        The vector is in cell_id order (see `obs_index`), zero for cells
+        without expression. With `obsm`, returns (values, coords), with
+        the coordinates of that embedding in the same cell order.
         """
-        rv = self.db.sql(sql).set_index('obs')['value']
-        rv.name = gene
-        return rv
+        import numpy as np
+
+        cell_ids, values = self.gene_nonzero(dataset_id, gene)
+        rv = np.zeros(self.n_cells(dataset_id), dtype=np.float32)
+        rv[cell_ids] = values
+        if obsm is None:
+            return rv
+        return rv, self.obsm(self.exp_id(dataset_id), obsm)
+
+
+    def genes(self, dataset_id: int, genes: List[str],
+              layer: Optional[str] = None,
+              format: str = 'csr'):
+        """Expression of a panel of genes, fetched with one query.
+
+        Returns a (cells x genes) matrix, cells in cell_id order and
+        genes in the order given (each once): a float32
+        `scipy.sparse.csr_matrix` for format 'csr', a NumPy array for
+        'dense', or a long dataframe (cell, gene, value) of the nonzero
+        entries for 'long'. With `layer`, the dataset of that layer of
+        the same experiment is used. Unknown genes raise KeyError,
+        names shared by several genes of the dataset ValueError.
+        """
+        import numpy as np
+        import pandas as pd
+        import pyarrow as pa
+        import scipy.sparse
+
+        if format not in ['csr', 'dense', 'long']:
+            raise ValueError(f"Unknown format {format}")
+        if layer is not None:
+            dataset_id = self.layer_dataset(dataset_id, layer)
+        genes = list(dict.fromkeys(genes))
+
+        self.db.conn.register('wanted_genes', pa.table({
+            'pos': np.arange(len(genes), dtype=np.int32),
+            'gene': pa.array(genes, pa.string())}))
+        try:
+            # genes that do not match exactly one gene_id
+            found = self.db.execute("""
+                SELECT wanted_genes.gene, COUNT(gene_dim.gene_id) AS n
+                  FROM wanted_genes
+                  LEFT JOIN gene_dim
+                    ON gene_dim.gene = wanted_genes.gene
+                   AND gene_dim.dataset_id = ?
+                 GROUP BY wanted_genes.gene
+                HAVING n != 1""", [dataset_id]).fetchnumpy()
+            missing = found['gene'][found['n'] == 0]
+            if len(missing):
+                raise KeyError(f"Unknown genes: {', '.join(missing)}")
+            if len(found['gene']):
+                raise ValueError(
+                    "Gene names not unique in dataset "
+                    f"{dataset_id}: {', '.join(found['gene'])}")
+            rv = self.db.execute("""
+                SELECT expr.cell_id, wanted_genes.pos, expr.value
+                  FROM expr
+                  JOIN gene_dim USING (dataset_id, gene_id)
+                  JOIN wanted_genes ON gene_dim.gene = wanted_genes.gene
+                 WHERE dataset_id = ?""", [dataset_id]).fetchnumpy()
+        finally:
+            self.db.conn.unregister('wanted_genes')
+
+        cell_ids = np.asarray(rv['cell_id'], dtype=np.int32)
+        pos = np.asarray(rv['pos'], dtype=np.int32)
+        values = np.asarray(rv['value'], dtype=np.float32)
+
+        if format == 'long':
+            cells = self.db.execute("""
+                SELECT obs FROM cell_dim
+                 WHERE dataset_id = ?
+                 ORDER BY cell_id""", [dataset_id]).fetchnumpy()['obs']
+            return pd.DataFrame(dict(
+                cell=pd.Categorical.from_codes(cell_ids, categories=cells),
+                gene=pd.Categorical.from_codes(pos, categories=genes),
+                value=values))
+
+        shape = (self.n_cells(dataset_id), len(genes))
+        if format == 'dense':
+            dense = np.zeros(shape, dtype=np.float32)
+            dense[cell_ids, pos] = values
+            return dense
+        return scipy.sparse.csr_matrix((values, (cell_ids, pos)),
+                                       shape=shape)
+
+
+    def layer_dataset(self, dataset_id: int, layer: str) -> int:
+        """The dataset of another layer of the same experiment."""
+        rv = self.db.execute("""
+            SELECT dataset_id FROM experiment_md
+             WHERE full_experiment_id = ?
+               AND layer_name = ?""",
+            [self.exp_id(dataset_id), layer]).fetchone()
+        if rv is None:
+            raise KeyError(f"Unknown layer {layer}")
+        return int(rv[0])
+
+
+    def dataset(self, dataset_id: int) -> "Dataset":
+        """A lazy, AnnData-like view on a dataset (see `Dataset`)."""
+        from .dataset import Dataset
+        return Dataset(self, dataset_id)
+
+
+    def _nonzero(self, dataset_id: int, axis: str,
+                 name: str) -> "Tuple[np.ndarray, np.ndarray]":
+        """Nonzero entries of one gene or cell (`axis`) of a dataset.
+
+        Returns (ids, values) - cell ids for a gene, gene ids for a
+        cell - sorted by id. Read from the packed vectors if the
+        dataset is packed (see `CHDB.pack_expr`), otherwise from expr.
+        Unknown names raise KeyError, names shared by several genes
+        (or cells) ValueError.
+        """
+        import numpy as np
+
+        from .packed import packed_dtype, unpack
+
+        table, key, index, _ = next(
+            t for t in self.db.PACKED_TABLES if t[1] == f'{axis}_id')
+        dim, name_col = {'gene': ('gene_dim', 'gene'),
+                         'cell': ('cell_dim', 'obs')}[axis]
+        dtype = packed_dtype(self.db.value_dtype(dataset_id))
+
+        ids = self.db.execute(f"""
+            SELECT {key} FROM {dim}
+             WHERE dataset_id = ?
+               AND {name_col} = ?""", [dataset_id, name]).fetchall()
+        if len(ids) == 0:
+            raise KeyError(f"Unknown {axis} {name}")
+        if len(ids) > 1:
+            raise ValueError(
+                f"{axis} name {name} is not unique in dataset {dataset_id}")
+        key_id = ids[0][0]
+
+        if self.db.table_exists(table):
+            rv = self.db.execute(f"""
+                SELECT {index}s, vals FROM {table}
+                 WHERE dataset_id = ?
+                   AND {key} = ?""", [dataset_id, key_id]).fetchall()
+            if rv:
+                return unpack(rv[0][0], rv[0][1], dtype)
+
+        rv = self.db.execute(f"""
+            SELECT {index}, value FROM expr
+             WHERE dataset_id = ?
+               AND {key} = ?
+             ORDER BY {index}""", [dataset_id, key_id]).fetchnumpy()
+        return (np.asarray(rv[index], dtype=np.int32),
+                np.asarray(rv['value'], dtype=dtype))
+
+
+    def gene_nonzero(self, dataset_id: int,
+                     gene: str) -> "Tuple[np.ndarray, np.ndarray]":
+        """Cell ids & values of the nonzero entries of a gene."""
+        return self._nonzero(dataset_id, 'gene', gene)
+
+
+    def cell_nonzero(self, dataset_id: int,
+                     cell: str) -> "Tuple[np.ndarray, np.ndarray]":
+        """Gene ids & values of the nonzero entries of a cell."""
+        return self._nonzero(dataset_id, 'cell', cell)
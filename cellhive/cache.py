@@ -0,0 +1,88 @@
+"""In-process cache for query results, bounded by size."""
+
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+
+def nbytes(value: Any) -> int:
+    """Rough size in memory of a query result."""
+    import sys
+
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        size = value.memory_usage(deep=True, index=True)
+        return int(size.sum() if isinstance(value, pd.DataFrame) else size)
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (pa.Table, pa.RecordBatch, pa.Array)):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def copy_result(value: Any) -> Any:
+    """A copy of a query result that can be modified safely.
+
+    Arrays, frames and the containers holding them are copied; Arrow
+    data and pandas indexes are immutable and returned as they are.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    if isinstance(value, dict):
+        return {k: copy_result(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_result(v) for v in value)
+    return value
+
+
+class ResultCache:
+    """Least recently used cache holding at most `max_bytes` of results.
+
+    A result larger than `max_bytes` is not cached.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, value)."""
+        if key not in self._items:
+            return False, None
+        self._items.move_to_end(key)
+        return True, self._items[key][0]
+
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self._items:
+            self.size -= self._items.pop(key)[1]
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, old) = self._items.popitem(last=False)
+            self.size -= old
+
+
+    def clear(self) -> None:
+        self._items.clear()
+        self.size = 0
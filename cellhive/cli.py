@@ -11,7 +11,7 @@ import logging
 import sys
 from functools import partial
 from pprint import pprint  # noqa: F401
-from typing import Any, Union
+from typing import Any, Tuple, Union
 
 import click
 from click.core import Context
@@ -68,11 +68,18 @@ def status(ctx: Context) -> None:
 @click.option("-T", "transpose",
               is_flag=True, show_default=False, default=False,
               help="transpose output.")
+@click.option("-o", "--out", type=click.Path(), default=None,
+              help="Write the result to a .parquet, .csv or .tsv file.")
 @click.pass_context
-def db_sql(ctx: Context, transpose: bool, sql: str) -> None:
+def db_sql(ctx: Context, transpose: bool, out: Union[str, None],
+           sql: str) -> None:
 
     "Run sql."
     sql = ' '.join(sql)
+    if out is not None:
+        # written by duckdb - large results never reach python
+        ctx.obj['chdb'].export(sql, out)
+        return
     rv = ctx.obj['chdb'].sql(sql)
     if transpose:
         print(rv.T)
@@ -87,37 +94,180 @@ def version() -> None:
 
 
 @db_group.command()
+@click.option("-g", "--group", "groups", multiple=True,
+              default=['cell_type'], show_default=True,
+              help="Categorical obs column(s) holding cell types, in "
+                   "order of preference.")
 @click.pass_context
 def meta_tables(
         ctx: Context,
+        groups: Tuple[str, ...],
 ) -> None:
 
     """(re-)build meta data tables."""
 
     # database object.
     chdb = ctx.obj['chdb']
+    chdb.rw()
+
+    # expr only holds nonzero values - so all statistics combine
+    # the nonzero rows with the dataset shape recorded at upload
+    lg.info("Create help_gene table")
+    chdb.sql("DROP TABLE IF EXISTS gene_meta")
+    chdb.sql("""
+       CREATE TABLE gene_meta AS
+           SELECT agg.dataset_id, agg.gene_id, gene_dim.gene,
+                  agg.sumval,
+                  agg.sumval / dataset_shape.n_cells AS meanval,
+                  agg.nnz,
+                  agg.nnz / dataset_shape.n_cells AS fracnonzero
+             FROM (SELECT dataset_id, gene_id,
+                          SUM(value) AS sumval,
+                          COUNT(*) AS nnz
+                     FROM expr
+                    GROUP BY dataset_id, gene_id) AS agg
+             JOIN gene_dim USING (dataset_id, gene_id)
+             JOIN dataset_shape USING (dataset_id)
+            ORDER BY agg.dataset_id ASC, agg.sumval DESC """)
 
     lg.info("Create experiment help table")
     chdb.sql("DROP TABLE IF EXISTS dataset_meta")
     chdb.sql("""
         CREATE TABLE dataset_meta AS
-          SELECT dataset_id,
-                 count(*) as no_datapoints,
-                 count(distinct obs) as no_cells,
-                 count(distinct gene) as no_genes
-            FROM expr
-           GROUP BY dataset_id""")
+          SELECT dataset_shape.dataset_id,
+                 CAST(COALESCE(SUM(gene_meta.nnz), 0) AS BIGINT)
+                     as no_datapoints,
+                 dataset_shape.n_cells as no_cells,
+                 dataset_shape.n_genes as no_genes
+            FROM dataset_shape
+            LEFT JOIN gene_meta USING (dataset_id)
+           GROUP BY ALL""")
 
-    lg.info("Create help_gene table")
-    chdb.sql("DROP TABLE IF EXISTS gene_meta")
+    # per gene (case insensitive), the mean & fraction expressing in
+    # each cell type group of each dataset - ranked by mean. Cells are
+    # grouped by the first of `groups` that is an obs column of the
+    # dataset; datasets without one form a single group 'all'.
+    lg.info("Create gene index")
+    grouped = """
+        SELECT NULL::INTEGER AS dataset_id, NULL::INTEGER AS gene_id,
+               NULL::VARCHAR AS cell_group, NULL::BIGINT AS n_cells,
+               NULL::DOUBLE AS sumval, NULL::BIGINT AS nnz
+         WHERE false"""
+    params = None
+    if chdb.table_exists('obs_cat'):
+        params = dict(groups=list(groups))
+        grouped = """
+          WITH ds_group AS (
+            SELECT md.dataset_id, md.full_experiment_id AS exp_id,
+                   arg_min(cols.name,
+                           list_position($groups, cols.name)) AS name
+              FROM experiment_md AS md
+              JOIN (SELECT DISTINCT exp_id, name FROM obs_cat) AS cols
+                ON cols.exp_id = md.full_experiment_id
+             WHERE list_contains($groups, cols.name)
+             GROUP BY ALL),
+          cell_group AS (
+            SELECT ds_group.dataset_id, obs_cat.cell_id,
+                   COALESCE(levels.level, 'NA') AS cell_group
+              FROM ds_group
+              JOIN obs_cat USING (exp_id, name)
+              LEFT JOIN obs_cat_levels AS levels
+                     USING (exp_id, name, code)),
+          group_size AS (
+            SELECT dataset_id, cell_group, COUNT(*) AS n_cells
+              FROM cell_group
+             GROUP BY ALL)
+          SELECT agg.dataset_id, agg.gene_id, agg.cell_group,
+                 group_size.n_cells, agg.sumval, agg.nnz
+            FROM (SELECT expr.dataset_id, expr.gene_id,
+                         cell_group.cell_group,
+                         SUM(expr.value) AS sumval,
+                         COUNT(*) AS nnz
+                    FROM expr
+                    JOIN cell_group USING (dataset_id, cell_id)
+                   GROUP BY ALL) AS agg
+            JOIN group_size USING (dataset_id, cell_group)"""
+
+    chdb.sql("DROP TABLE IF EXISTS gene_index")
     chdb.sql("""
-       CREATE TABLE gene_meta AS
-           SELECT distinct dataset_id, gene,
-                  SUM(value) AS sumval,
-                  SUM(LEAST(value, 1)) / COUNT(value) AS fracnonzero
-             FROM expr
-            GROUP BY dataset_id, gene
-            ORDER BY dataset_id ASC, sumval DESC """)
+        CREATE TABLE gene_index (
+            gene_key VARCHAR PRIMARY KEY,
+            entries STRUCT(gene VARCHAR, dataset_id INTEGER,
+                           cell_group VARCHAR, n_cells BIGINT,
+                           meanval DOUBLE, fracnonzero DOUBLE)[])""")
+    chdb.sql(f"""
+        INSERT INTO gene_index
+          WITH grouped AS ({grouped}),
+          stats AS (
+            SELECT * FROM grouped
+             UNION ALL
+            SELECT gene_meta.dataset_id, gene_meta.gene_id,
+                   'all' AS cell_group, dataset_shape.n_cells,
+                   gene_meta.sumval, gene_meta.nnz
+              FROM gene_meta
+              JOIN dataset_shape USING (dataset_id)
+             WHERE gene_meta.dataset_id NOT IN (
+                     SELECT dataset_id FROM grouped))
+          SELECT upper(gene_dim.gene) AS gene_key,
+                 list(struct_pack(
+                        gene := gene_dim.gene,
+                        dataset_id := stats.dataset_id,
+                        cell_group := stats.cell_group,
+                        n_cells := stats.n_cells,
+                        meanval := stats.sumval / stats.n_cells,
+                        fracnonzero := stats.nnz / stats.n_cells)
+                      ORDER BY stats.sumval / stats.n_cells DESC)
+            FROM stats
+            JOIN gene_dim USING (dataset_id, gene_id)
+           GROUP BY upper(gene_dim.gene)
+           -- sorted, so a lookup skips all but one row group
+           ORDER BY gene_key""", params)
+
+
+@db_group.command()
+@click.option("-d", "--dataset", "dataset_ids", type=int, multiple=True,
+              help="Only rewrite these datasets (default: all).")
+@click.pass_context
+def optimize(ctx: Context, dataset_ids: Tuple[int, ...]) -> None:
+    """Cluster the expression table by dataset & gene.
+
+    Speeds up single gene lookups; see also `upload --cluster`.
+    """
+    chdb = ctx.obj['chdb']
+    chdb.rw()
+    chdb.cluster_expr(list(dataset_ids) if dataset_ids else None)
+
+
+@db_group.command()
+@click.option("-d", "--dataset", "dataset_ids", type=int, multiple=True,
+              help="Only pack these datasets (default: all).")
+@click.pass_context
+def pack(ctx: Context, dataset_ids: Tuple[int, ...]) -> None:
+    """Build packed per-gene & per-cell expression vectors.
+
+    A packed gene is read with a single row fetch; re-uploading a
+    dataset drops its packed vectors, run this again afterwards.
+    """
+    chdb = ctx.obj['chdb']
+    chdb.rw()
+    chdb.pack_expr(list(dataset_ids) if dataset_ids else None)
+
+
+@db_group.command()
+@click.argument("mode", required=False,
+                type=click.Choice(['table', 'parquet']))
+@click.pass_context
+def storage(ctx: Context, mode: Union[str, None]) -> None:
+    """Show or switch how expression data is stored.
+
+    'table' keeps expr in the database file, 'parquet' writes one
+    Parquet partition per dataset next to it (<db>.expr/).
+    """
+    chdb = ctx.obj['chdb']
+    if mode is not None:
+        chdb.rw()
+        chdb.set_storage_mode(mode)
+    print(chdb.storage_mode())
 
 
 #add external commands
@@ -1,6 +1,8 @@
 
 import logging
 from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import click
 from click.core import Context
@@ -8,47 +10,111 @@ from click.core import Context
 from . import db
 from . import metadata_tools as mdtools
 from . import util
+from .ingest import DEFAULT_CHUNKSIZE
 
 lg = logging.getLogger(__name__)
 
 
-@click.command("upload")
-@click.argument('h5ad', type=click.Path(exists=True))
-@click.option("-c", "skip_counts", is_flag=True, default=False,
-              help="Skip count table.")
-@click.option("-F", "force", is_flag=True, default=False,
-              help="Ignore problems, try to upload anyhow.")
-@click.option("-o", "skip_obs", is_flag=True, default=False,
-              help="Skip obs table.")
-@click.option("-m", "skip_obsm", is_flag=True, default=False,
-              help="Skip obsm table.")
-@click.pass_context
-def upload(ctx: Context,
-           h5ad: str,
-           force: bool,
-           skip_counts: bool,
-           skip_obs: bool,
-           skip_obsm: bool,) -> None:
-    """Upload an h5ad file to the database."""
+def find_h5ad_files(paths: Sequence[str]) -> List[Path]:
+    """Expand files, directories and manifests into a list of h5ad files.
+
+    Directories are searched (recursively) for *.h5ad files; any other
+    non-h5ad file is read as a manifest with one path per line
+    (relative to the manifest, # starts a comment).
+    """
+    rv: List[Path] = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            rv.extend(sorted(path.rglob('*.h5ad')))
+        elif path.suffix == '.h5ad':
+            rv.append(path)
+        else:
+            with open(path) as F:
+                for line in F:
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        rv.append(path.parent / line)
+    # each file once, in the order given
+    return list(dict.fromkeys(p.resolve() for p in rv))
+
+
+def prepare_h5ad(h5ad: str, backed: bool) -> Dict[str, Any]:
+    """Read an h5ad file and gather what the upload needs.
+
+    This is the part of an upload that does not touch the database, so
+    it can run ahead (in a thread) for the next file in a batch.
+    """
+    from .ingest import open_h5ad
+
+    # import the h5ad file
+    h5file = None
+    if backed:
+        # only obs, var, obsm & uns are loaded
+        adata, h5file = open_h5ad(h5ad)
+    else:
+        # scanpy is only needed to load a file in full
+        import scanpy as sc
+        adata = sc.read_h5ad(h5ad)
+
+    rv = dict(adata=adata, h5file=h5file)
+
+    try:
+        # check if there are problems.
+        rv['problems'] = mdtools.check_2(adata)
+        if not rv['problems']:
+            # layer statistics stream over all matrices
+            rv['layerdata'] = mdtools.layers(
+                adata, h5file=h5file, fingerprint=True)
+    except Exception:
+        # the caller only closes the file of a prepared upload
+        if h5file is not None:
+            h5file.close()
+        raise
+    return rv
+
+
+def upload_h5ad(chdb: "db.CHDB",
+                h5ad: str,
+                prepared: Dict[str, Any],
+                force: bool = False,
+                skip_counts: bool = False,
+                skip_obs: bool = False,
+                skip_obsm: bool = False,
+                jobs: int = 1,
+                chunksize: int = DEFAULT_CHUNKSIZE,
+                quantize: float = 0,
+                rewrite: bool = False,
+                obsm_dims: Optional[int] = None,
+                cluster: bool = False) -> bool:
+    """Upload one (prepared) h5ad file to the database.
+
+    Non-count layers are rounded to within `quantize` of their value,
+    if set. Of each obsm, at most `obsm_dims` dimensions are stored
+    (all if None). With `cluster`, the expression rows are ordered by
+    gene (see `CHDB.cluster_expr`). Layers, obs columns and obsm
+    blocks whose content hash matches the one stored are not written
+    again, unless `rewrite` is set. Returns False if the file has
+    problems and `force` is not set. The caller closes the backed file
+    of `prepared`.
+    """
 
     # late import to speed up matters
+    import tempfile
+
+    import numpy as np
     import pandas as pd
-    import scanpy as sc
 
-    # database object.
-    chdb = ctx.obj['chdb']
-    chdb.rw()
+    from .ingest import fingerprint, get_names, value_dtype, write_shards
 
-    # import the h5ad file
-    adata = sc.read_h5ad(h5ad)
+    adata = prepared['adata']
+    h5file = prepared['h5file']
 
-    # check if there are problems.
-    problems = mdtools.check_2(adata)
+    problems = prepared['problems']
     if problems:
         for p in problems:
             print(p)
         if not force:
-            return
+            return False
 
     # helper fuction
     mdget = partial(util.mdget, data=adata.uns['cellhive'])
@@ -68,9 +134,21 @@ def upload(ctx: Context,
     expdata['full_experiment'] = full_exp_name = \
         f"{study}__{expname}__{version}"
 
-    expdata['full_experiment_id'] = \
+    expdata['full_experiment_id'] = exp_id = \
         chdb.get_id('experiment_md', 'full_experiment', full_exp_name)
 
+    def unchanged(key: str, hash: str) -> bool:
+        """Is this part in the database already, with the same content?"""
+        if not rewrite and chdb.get_fingerprint(key) == hash:
+            lg.info(f"{key} is unchanged, skipping")
+            return True
+        return False
+
+    # obs & obsm columns are collected, and stored in one go
+    obs_columns: Dict[str, Tuple[Any, str]] = {}
+    obsm_blocks: Dict[str, Any] = {}
+    obs_hashes: Dict[str, str] = {}
+
     #OBSM
     if not skip_obsm:
         obsm_data = mdtools.obsm(adata)
@@ -80,19 +158,17 @@ def upload(ctx: Context,
             if str(obsm['ignore']) == 'True':
                 continue
             lg.info(f'import obsm {obsm_name}')
-            obd = adata.obsm[str(obsm_name)]
-            lg.info(f"storing obsm col {obsm_name}")
-            chdb.store_obscol(
-                col=pd.Series(obd[:,0], index=adata.obs_names),
-                name=f"{obsm_name}/0",
-                dtype='float',
-                exp_id=expdata['full_experiment_id'])
-
-            chdb.store_obscol(
-                col=pd.Series(obd[:,1], index=adata.obs_names),
-                name=f"{obsm_name}/1",
-                dtype='float',
-                exp_id=expdata['full_experiment_id'])
+            # all dimensions, unless limited (e.g. top-k of a PCA)
+            dims = obsm_dims
+            if str(obsm['dims']) != '-':
+                dims = int(obsm['dims'])
+            obd = np.asarray(adata.obsm[str(obsm_name)])[:, :dims]
+            fkey = f"obsm/{exp_id}/{obsm_name}"
+            fhash = fingerprint(adata.obs_names, obd)
+            if unchanged(fkey, fhash):
+                continue
+            obsm_blocks[str(obsm_name)] = obd
+            obs_hashes[fkey] = fhash
 
     #OBS
     if not skip_obs:
@@ -103,15 +179,30 @@ def upload(ctx: Context,
                 lg.info(f"Ignoring obs col {obs['name']}")
                 continue
 
-            lg.info(f"storing obs col {obs['name']}")
-            chdb.store_obscol(
-                col=adata.obs[od['name']],
-                name=obs['name'],
-                dtype=obs['dtype'],
-                exp_id=expdata['full_experiment_id'])
+            fkey = f"obs/{exp_id}/{obs['name']}"
+            fhash = fingerprint(adata.obs[od['name']], obs['dtype'])
+            if unchanged(fkey, fhash):
+                continue
+
+            obs_columns[obs['name']] = (adata.obs[od['name']], obs['dtype'])
+            obs_hashes[fkey] = fhash
+
+    if obs_columns or obsm_blocks:
+        lg.info(f"storing {len(obs_columns)} obs columns & "
+                f"{len(obsm_blocks)} obsm blocks")
+        chdb.store_obs(exp_id, adata.obs_names, obs_columns,
+                       obsm=obsm_blocks, fingerprints=obs_hashes)
 
     # Layers!
-    layerdata = mdtools.layers(adata)
+    layerdata = prepared.get('layerdata')
+    if layerdata is None:
+        layerdata = mdtools.layers(adata, h5file=h5file, fingerprint=True)
+    # layer name -> dataset id, for the parallel upload
+    shard_layers = {}
+    # fingerprints to store once the shards are loaded
+    shard_hashes = {}
+    # datasets loaded chunk by chunk, to cluster afterwards
+    imported = []
     assert layerdata is not None
     for _, linfo in layerdata.items():
         if str(linfo['ignore']) == 'True':
@@ -130,10 +221,213 @@ def upload(ctx: Context,
         chdb.uac_experiment_md(expdata_l)
 
 
-        if not skip_counts:
+        # compact storage type, based on the layer type
+        dtype = value_dtype(linfo['layer_type'], linfo['max'])
+        step = 2 * quantize if linfo['layer_type'] != 'count' else 0
+
+        if skip_counts:
+            continue
+
+        names = get_names(adata, lname, h5file)
+        fkey = f"layer/{dataset_id}"
+        fhash = fingerprint(linfo['fingerprint'], dtype, step, *names)
+        if unchanged(fkey, fhash):
+            continue
+
+        if jobs > 1:
+            shard_layers[lname] = (dataset_id, dtype, step)
+            shard_hashes[fkey] = fhash
+            chdb.store_dims(dataset_id, *names)
+            chdb.store_value_dtype(dataset_id, dtype, step)
+        else:
             lg.info("Start count import")
 
             chdb.import_count_table(
                 dataset_id=dataset_id,
                 adata=adata,
-                layer=lname)
+                layer=lname,
+                chunksize=chunksize,
+                h5file=h5file,
+                dtype=dtype,
+                step=step)
+            chdb.set_fingerprint(fkey, fhash)
+            imported.append(dataset_id)
+
+    if cluster and imported:
+        chdb.cluster_expr(imported)
+
+    if h5file is not None:
+        # closed before the shard workers open it
+        h5file.close()
+
+    if shard_layers:
+        lg.info("Start parallel count import")
+        # shards are written next to the database
+        with tempfile.TemporaryDirectory(
+                prefix='.cellhive_shards_',
+                dir=Path(chdb.dbfile).parent) as shard_dir:
+            paths = write_shards(
+                h5ad, shard_layers, shard_dir,
+                jobs=jobs, chunksize=chunksize)
+            chdb.import_parquet_shards(
+                [x[0] for x in shard_layers.values()], paths,
+                cluster=cluster)
+        for fkey, fhash in shard_hashes.items():
+            chdb.set_fingerprint(fkey, fhash)
+
+    return True
+
+
+@click.command("upload")
+@click.argument('h5ad', nargs=-1, required=True,
+                type=click.Path(exists=True))
+@click.option("-c", "skip_counts", is_flag=True, default=False,
+              help="Skip count table.")
+@click.option("-F", "force", is_flag=True, default=False,
+              help="Ignore problems, try to upload anyhow.")
+@click.option("-o", "skip_obs", is_flag=True, default=False,
+              help="Skip obs table.")
+@click.option("-m", "skip_obsm", is_flag=True, default=False,
+              help="Skip obsm table.")
+@click.option("-b", "--backed", is_flag=True, default=False,
+              help="Stream matrices from disk, do not load them in memory.")
+@click.option("--max-memory", type=str, default=None,
+              help="Memory budget for the upload, e.g. 8GB (implies -b).")
+@click.option("-j", "--jobs", type=int, default=1,
+              help="Worker processes converting layers to Parquet "
+                   "shards (implies -b).")
+@click.option("-P", "--prefetch", type=int, default=None,
+              help="Number of files prepared ahead, in parallel "
+                   "(default: 1 with -b, else 0 as each is loaded in "
+                   "full).")
+@click.option("--redo", is_flag=True, default=False,
+              help="Upload files that were uploaded before.")
+@click.option("--obsm-dims", type=int, default=None,
+              help="Store at most this many dimensions of each obsm "
+                   "(default: all).")
+@click.option("--cluster", is_flag=True, default=False,
+              help="Order expression rows by gene, for fast single "
+                   "gene lookups.")
+@click.option("--rewrite", is_flag=True, default=False,
+              help="Also rewrite layers, obs & obsm that did not change.")
+@click.option("-q", "--quantize", type=float, default=0,
+              help="Store non-count values rounded, with at most this "
+                   "absolute error.")
+@click.pass_context
+def upload(ctx: Context,
+           h5ad: Tuple[str],
+           force: bool,
+           skip_counts: bool,
+           skip_obs: bool,
+           skip_obsm: bool,
+           backed: bool,
+           max_memory: Optional[str],
+           jobs: int,
+           prefetch: Optional[int],
+           redo: bool,
+           rewrite: bool,
+           quantize: float,
+           obsm_dims: Optional[int],
+           cluster: bool,) -> None:
+    """Upload h5ad files to the database.
+
+    Takes h5ad files, directories with h5ad files, or manifest files
+    listing h5ad files. The state of each file is tracked in the
+    upload_job table; files already uploaded (and unchanged since) are
+    skipped.
+    """
+
+    # late import to speed up matters
+    from concurrent.futures import ThreadPoolExecutor
+
+    from .ingest import chunksize_for
+
+    # database object - one writer connection for all files
+    chdb = ctx.obj['chdb']
+    chdb.rw()
+    chdb.upgrade_obs_tables()
+    chdb.upgrade_expr_table()
+
+    if jobs > 1:
+        # workers read the matrices from disk themselves
+        backed = True
+
+    chunksize = DEFAULT_CHUNKSIZE
+    if max_memory is not None:
+        backed = True
+        # half for the chunks we build (shared by all workers), half
+        # for duckdb
+        budget = util.parse_size(max_memory) // 2
+        chunksize = chunksize_for(budget // jobs)
+        chdb.set_memory_limit(f"{max(64, budget // 1024**2)}MB")
+        lg.info(f"memory budget {max_memory}: {chunksize:_d} values/chunk")
+
+    if prefetch is None:
+        # a file that is not backed is held in memory in full while
+        # it waits for its upload
+        prefetch = 1 if backed else 0
+
+    todo = []
+    failed = 0
+    for path in find_h5ad_files(h5ad):
+        try:
+            stat = path.stat()
+        except OSError as e:
+            # e.g. a stale manifest entry
+            lg.error(f"cannot upload {path}: {e}")
+            chdb.set_upload_job(path=str(path), size=0, mtime=0,
+                                status='failed', message=str(e))
+            failed += 1
+            continue
+        job = dict(path=str(path), size=stat.st_size, mtime=stat.st_mtime)
+        if not redo and chdb.upload_job_done(**job):
+            lg.info(f"skipping {path}, uploaded before")
+            continue
+        todo.append(job)
+
+    lg.info(f"uploading {len(todo)} file(s)")
+    n_files = len(todo) + failed
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as pool:
+        pending: Dict[int, Any] = {}
+        for i, job in enumerate(todo):
+            # keep `prefetch` files in preparation ahead of the upload
+            for ahead in range(i + 1, min(i + 1 + prefetch, len(todo))):
+                if ahead not in pending:
+                    pending[ahead] = pool.submit(
+                        prepare_h5ad, todo[ahead]['path'], backed)
+
+            lg.info(f"[{i + 1}/{len(todo)}] upload {job['path']}")
+            chdb.set_upload_job(status='running', **job)
+            prepared = None
+            try:
+                if i in pending:
+                    prepared = pending.pop(i).result()
+                else:
+                    prepared = prepare_h5ad(job['path'], backed)
+                ok = upload_h5ad(
+                    chdb, job['path'], prepared,
+                    force=force, skip_counts=skip_counts,
+                    skip_obs=skip_obs, skip_obsm=skip_obsm,
+                    jobs=jobs, chunksize=chunksize,
+                    quantize=quantize, rewrite=rewrite,
+                    obsm_dims=obsm_dims, cluster=cluster)
+            except Exception as e:
+                lg.exception(f"upload of {job['path']} failed")
+                chdb.set_upload_job(status='failed', message=str(e), **job)
+                failed += 1
+                continue
+            finally:
+                # the backed file is open until here, also on failure
+                if prepared is not None and prepared['h5file'] is not None:
+                    prepared['h5file'].close()
+
+            if ok:
+                chdb.set_upload_job(status='done', **job)
+            else:
+                chdb.set_upload_job(
+                    status='failed', message='metadata problems', **job)
+                failed += 1
+
+    if failed:
+        lg.error(f"{failed} of {n_files} upload(s) failed")
+        ctx.exit(1)
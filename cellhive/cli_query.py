@@ -12,16 +12,45 @@ def query(ctx: Context):
 @query.command
 @click.pass_context
 @click.argument('gene')
-def gene(ctx: Context, gene: str):
+@click.option("-n", "--top", type=int, default=20, show_default=True,
+              help="Number of cell groups to show.")
+@click.option("--by", type=click.Choice(['mean', 'frac']), default='mean',
+              show_default=True, help="Rank by mean or by fraction of "
+                                      "cells expressing.")
+@click.option("-l", "--layer", "layer_type", default='logrpm',
+              type=click.Choice(['count', 'rpm', 'logrpm',
+                                 'cell_abundance']),
+              show_default=True, help="Only rank datasets of this layer "
+                                      "type.")
+def gene(ctx: Context, gene: str, top: int, by: str, layer_type: str):
+    """Where is a gene expressed, across all datasets?
+
+    Ranks the cell type groups of all datasets (see `ch db
+    meta-tables`) by expression of GENE; gene names are matched case
+    insensitively. Means are only comparable within a layer type, so
+    only datasets of one layer type are ranked.
+    """
     chdb = ctx.obj['chdb']
 
+    if not chdb.table_exists('gene_index'):
+        raise click.ClickException(
+            "No gene index, run `ch db meta-tables` first")
+
+    # a single lookup on the gene_index primary key
+    order = 'meanval' if by == 'mean' else 'fracnonzero'
     sql = f"""
-        SELECT experiment_md.dataset, gene_meta.fracnonzero
-          FROM gene_meta
-          JOIN experiment_md ON gene_meta.dataset_id = experiment_md.dataset_id
-         WHERE gene = '{gene}'
-         ORDER BY fracnonzero DESC
-         LIMIT 5
+        SELECT experiment_md.dataset, entry.cell_group, entry.n_cells,
+               entry.meanval, entry.fracnonzero
+          FROM (SELECT unnest(entries) AS entry
+                  FROM gene_index
+                 WHERE gene_key = upper(?))
+          JOIN experiment_md ON experiment_md.dataset_id = entry.dataset_id
+         WHERE experiment_md.layer_type = ?
+         ORDER BY entry.{order} DESC
+         LIMIT ?
     """
-    result = chdb.sql(sql)
+    result = chdb.sql(sql, [gene, layer_type, top])
+    if len(result) == 0:
+        raise click.ClickException(
+            f"Gene {gene} not found in {layer_type} datasets")
     print(result.to_string(index=False))
@@ -0,0 +1,308 @@
+"""Lazy AnnData-like view on a stored dataset."""
+
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Mapping, Optional
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from anndata import AnnData
+
+    from .api import API
+
+
+class Dataset:
+    """A dataset in the database, fetched piece by piece.
+
+    Returned by `API.dataset`. `obs`, `var` and `obsm` are read on
+    first use and cached; `ds[cells, genes]` returns a view on a block
+    of the dataset, with cells & genes given as slices, boolean masks,
+    positions or names. `X` of a view fetches only that block from
+    the database. `to_anndata` builds a real AnnData object.
+    """
+
+    def __init__(self,
+                 api: "API",
+                 dataset_id: int,
+                 cell_ids: Optional["np.ndarray"] = None,
+                 gene_ids: Optional["np.ndarray"] = None,
+                 root: Optional["Dataset"] = None) -> None:
+        self.api = api
+        self.dataset_id = dataset_id
+        # None means all cells / genes, in id order
+        self._cell_ids = cell_ids
+        self._gene_ids = gene_ids
+        # obs, var & obsm are cached on the full dataset
+        self._root = self if root is None else root
+        self._cache: Dict[str, Any] = {}
+
+
+    @property
+    def is_view(self) -> bool:
+        return self._root is not self
+
+
+    def _cached(self, key: str, fetch: Any) -> Any:
+        """Fetch something once, caching it on the full dataset."""
+        cache = self._root._cache
+        if key not in cache:
+            cache[key] = fetch()
+        return cache[key]
+
+
+    @property
+    def exp_id(self) -> int:
+        return self._cached(
+            'exp_id', lambda: self.api.exp_id(self.dataset_id))
+
+
+    @property
+    def cell_ids(self) -> "np.ndarray":
+        """Cell ids of this view, in order."""
+        import numpy as np
+        if self._cell_ids is None:
+            return np.arange(self._cached(
+                'n_cells', lambda: self.api.n_cells(self.dataset_id)),
+                dtype=np.int32)
+        return self._cell_ids
+
+
+    @property
+    def gene_ids(self) -> "np.ndarray":
+        """Gene ids of this view, in order."""
+        import numpy as np
+        if self._gene_ids is None:
+            return np.arange(self._cached(
+                'n_genes', lambda: self.api.n_genes(self.dataset_id)),
+                dtype=np.int32)
+        return self._gene_ids
+
+
+    @property
+    def shape(self):
+        return len(self.cell_ids), len(self.gene_ids)
+
+
+    @property
+    def n_obs(self) -> int:
+        return self.shape[0]
+
+
+    @property
+    def n_vars(self) -> int:
+        return self.shape[1]
+
+
+    def __repr__(self) -> str:
+        view = " (view)" if self.is_view else ""
+        return (f"Dataset {self.dataset_id}{view}: "
+                f"{self.n_obs} cells x {self.n_vars} genes")
+
+
+    def _full_obs_names(self) -> "pd.Index":
+        import pandas as pd
+
+        cells = self.api.db.execute("""
+            SELECT obs FROM cell_dim
+             WHERE dataset_id = ?
+             ORDER BY cell_id""", [self.dataset_id]).fetchnumpy()['obs']
+        return pd.Index(cells, name='cell')
+
+
+    def _full_obs(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        api, exp_id = self.api, self.exp_id
+        rv = pd.DataFrame(
+            index=self._cached('obs_names', self._full_obs_names))
+        if not api.db.table_exists('obs_cat'):
+            # no obs stored for this database
+            return rv
+
+        parts = []
+        cat_names = list(api.obs_names_cat(exp_id)['name'])
+        if cat_names:
+            parts.append(api.obs_cat(exp_id, cat_names))
+        num_names = list(api.obs_names_num(exp_id)['name'])
+        if num_names:
+            parts.append(api.obs_num(exp_id, num_names))
+        for part in parts:
+            # obs & cell_dim share the cell order
+            for name in part:
+                rv[name] = part[name].array
+        return rv
+
+
+    def _full_var(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        genes = self.api.db.execute("""
+            SELECT gene FROM gene_dim
+             WHERE dataset_id = ?
+             ORDER BY gene_id""", [self.dataset_id]).fetchnumpy()['gene']
+        return pd.DataFrame(index=pd.Index(genes, name='gene'))
+
+
+    @property
+    def obs(self) -> "pd.DataFrame":
+        """All obs columns of the cells in this view."""
+        obs = self._cached('obs', self._full_obs)
+        return obs if self._cell_ids is None else obs.iloc[self._cell_ids]
+
+
+    @property
+    def var(self) -> "pd.DataFrame":
+        """The genes of this view (gene names as index)."""
+        var = self._cached('var', self._full_var)
+        return var if self._gene_ids is None else var.iloc[self._gene_ids]
+
+
+    @property
+    def obs_names(self) -> "pd.Index":
+        """Names of the cells in this view - without fetching obs."""
+        names = self._cached('obs_names', self._full_obs_names)
+        return names if self._cell_ids is None else names[self._cell_ids]
+
+
+    @property
+    def var_names(self) -> "pd.Index":
+        return self.var.index
+
+
+    @property
+    def obsm(self) -> "LazyObsm":
+        """Embeddings of the cells in this view, fetched by name."""
+        return LazyObsm(self)
+
+
+    def _select(self, sel: Any, ids: "np.ndarray",
+                names: "pd.Index") -> "np.ndarray":
+        """Ids selected by `sel`, relative to `ids` (with `names`)."""
+        import numpy as np
+
+        if isinstance(sel, slice) and sel == slice(None):
+            return ids
+        if isinstance(sel, slice):
+            return ids[sel]
+        if isinstance(sel, (str, int, np.integer)):
+            sel = [sel]
+        sel = np.asarray(sel)
+        if sel.dtype == bool:
+            if len(sel) != len(ids):
+                raise IndexError("Boolean mask does not match the shape")
+            return ids[sel]
+        if sel.dtype.kind in 'iu':
+            return ids[sel]
+        pos = names.get_indexer(sel)
+        if (pos < 0).any():
+            raise KeyError(f"Unknown names: {', '.join(sel[pos < 0][:5])}")
+        return ids[pos]
+
+
+    def __getitem__(self, index: Any) -> "Dataset":
+        if not isinstance(index, tuple):
+            index = (index, slice(None))
+        cells, genes = index
+        cell_ids = self._cell_ids
+        if not (isinstance(cells, slice) and cells == slice(None)):
+            cell_ids = self._select(cells, self.cell_ids, self.obs_names)
+        gene_ids = self._gene_ids
+        if not (isinstance(genes, slice) and genes == slice(None)):
+            gene_ids = self._select(genes, self.gene_ids, self.var_names)
+        return Dataset(self.api, self.dataset_id, cell_ids, gene_ids,
+                       root=self._root)
+
+
+    @property
+    def X(self) -> "Any":
+        """Expression of this view, as a float32 CSR matrix.
+
+        Only the rows of the selected cells & genes are read from the
+        database; the result is cached on the view.
+        """
+        if 'X' not in self._cache:
+            self._cache['X'] = self._fetch_x()
+        return self._cache['X']
+
+
+    def _fetch_x(self) -> Any:
+        import numpy as np
+        import pyarrow as pa
+        import scipy.sparse
+
+        conn = self.api.db.conn
+        joins, row, col = [], 'expr.cell_id', 'expr.gene_id'
+        registered = []
+        for name, ids, key in [('sel_cells', self._cell_ids, 'cell_id'),
+                               ('sel_genes', self._gene_ids, 'gene_id')]:
+            if ids is None:
+                continue
+            conn.register(name, pa.table({
+                key: pa.array(ids, pa.int32()),
+                'pos': np.arange(len(ids), dtype=np.int32)}))
+            registered.append(name)
+            joins.append(f"JOIN {name} USING ({key})")
+            if key == 'cell_id':
+                row = 'sel_cells.pos'
+            else:
+                col = 'sel_genes.pos'
+        try:
+            rv = self.api.db.execute(f"""
+                SELECT {row} AS row, {col} AS col, expr.value
+                  FROM expr
+                  {' '.join(joins)}
+                 WHERE expr.dataset_id = ?""",
+                [self.dataset_id]).fetchnumpy()
+        finally:
+            for name in registered:
+                conn.unregister(name)
+
+        return scipy.sparse.csr_matrix(
+            (np.asarray(rv['value'], dtype=np.float32),
+             (np.asarray(rv['row'], dtype=np.int32),
+              np.asarray(rv['col'], dtype=np.int32))),
+            shape=self.shape)
+
+
+    def to_anndata(self) -> "AnnData":
+        """Materialize this view as an AnnData object."""
+        import anndata as ad
+
+        obs = self.obs.copy()
+        obs.index = obs.index.astype(str)
+        var = self.var.copy()
+        var.index = var.index.astype(str)
+        return ad.AnnData(X=self.X, obs=obs, var=var,
+                          obsm={name: self.obsm[name]
+                                for name in self.obsm})
+
+
+class LazyObsm(Mapping):
+    """obsm of a `Dataset`: embeddings are fetched on first access."""
+
+    def __init__(self, dataset: Dataset) -> None:
+        self.dataset = dataset
+
+
+    def _names(self):
+        ds = self.dataset
+        return ds._cached('obsm_names',
+                          lambda: ds.api.obsm_names(ds.exp_id))
+
+
+    def __getitem__(self, name: str) -> "np.ndarray":
+        ds = self.dataset
+        if name not in self._names():
+            raise KeyError(name)
+        coords = ds._cached(f'obsm/{name}',
+                            lambda: ds.api.obsm(ds.exp_id, name))
+        if ds._cell_ids is None:
+            return coords
+        return coords[ds._cell_ids]
+
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names())
+
+
+    def __len__(self) -> int:
+        return len(self._names())
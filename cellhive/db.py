@@ -2,12 +2,19 @@
 
 import logging
 import os
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Union
+from typing import (TYPE_CHECKING, Any, Dict, Iterator, List, Optional,
+                    Sequence, Tuple, Union)
 
 from typing_extensions import LiteralString
 
+from .ingest import DEFAULT_CHUNKSIZE
+
 if TYPE_CHECKING:
+    import h5py
+    import numpy as np
     import pandas as pd
     from anndata import AnnData
 
@@ -15,6 +22,28 @@ if TYPE_CHECKING:
 lg = logging.getLogger()
 
 
+def _bindable(params: Any) -> Any:
+    """Query parameters in a form DuckDB can bind.
+
+    DuckDB does not take NumPy scalars, such as ids read from a query
+    result: these (and arrays) are converted to Python values.
+    """
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {k: _bindable(v) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [_bindable(v) for v in params]
+    if hasattr(params, 'tolist'):
+        return params.tolist()
+    return params
+
+
+def _literal(path: Any) -> str:
+    """A path as a SQL string literal, for where DuckDB cannot bind it."""
+    return "'" + str(path).replace("'", "''") + "'"
+
+
 class CHDB:
     """
     One class wraps many db functions.
@@ -26,6 +55,8 @@ class CHDB:
         dataset doi experiment experiment_id full_experiment genes
         layer_name organism pubmed study study_id title version year""".split()
 
+    RESULT_FORMATS = ['pandas', 'arrow', 'numpy', 'polars']
+
     def __init__(self,
                  dbfile: Optional[str] = None,
                  read_only: bool = False) -> None:
@@ -45,11 +76,17 @@ class CHDB:
         lg.debug(f'connect to {self.dbfile}')
 
         self.read_only = read_only
+        # generations seen, see `generation`
+        self._generations: Dict[str, int] = {}
+        # is a `transaction` open?
+        self._in_transaction = False
         try:
             self.conn = duckdb.connect(self.dbfile, read_only=read_only)
         except duckdb.CatalogException:
             # db does not exists?
             self.conn = None
+        else:
+            self._open_expr_view()
 
     def rw(self):
         """Reopen the connection in RW"""
@@ -60,13 +97,23 @@ class CHDB:
         if self.conn is not None:
             self.conn.close()
         self.read_only = False
+        self._generations.clear()
         self.conn = duckdb.connect(self.dbfile, read_only=False)
+        self._open_expr_view()
+
+
+    def set_memory_limit(self, limit: str) -> None:
+        """Limit the memory duckdb may use (e.g. '4GB')."""
+        self.execute("SET memory_limit = ?", [limit])
 
 
     def status(self) -> Dict[str, Any]:
         """Return a few db statistics."""
         rv = {}
         rv['dbsize'] = os.path.getsize(self.dbfile)
+        if self.expr_dir.exists():
+            rv['exprsize'] = sum(
+                f.stat().st_size for f in self.expr_dir.rglob('*.parquet'))
         for table, tcount in self.all_table_count().items():
             rv[table] = tcount
         return rv
@@ -74,10 +121,10 @@ class CHDB:
 
     def table_exists(self, table: str) -> bool:
         """Check if a table exists."""
-        rv = self.sql(f"""
+        rv = self.sql("""
             SELECT EXISTS(
                 SELECT 1 FROM information_schema.tables
-                 WHERE table_name = '{table}')""")
+                 WHERE table_name = ?)""", [table])
 
         return bool(rv.iloc[0,0])
 
@@ -96,53 +143,164 @@ class CHDB:
         return rv['cnt'].iloc[0]
 
 
-    def sql(self, sql: str) -> "pd.DataFrame":
-        """Run SQL and return a Pandas Dataframe of the results."""
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run a block in one transaction, rolled back on error.
 
-        import pandas as pd
-        result = self.conn.sql(sql)
+        A block nested in another joins the outer transaction.
+        """
+        if self._in_transaction:
+            yield
+            return
+        self.execute("BEGIN TRANSACTION")
+        self._in_transaction = True
+        try:
+            yield
+            self.execute("COMMIT")
+        except Exception:
+            self.execute("ROLLBACK")
+            raise
+        finally:
+            self._in_transaction = False
+
+
+    def execute(self,
+                sql: str,
+                params: Optional[Union[Sequence[Any], Dict[str, Any]]] = None,
+                ) -> Any:
+        """Run SQL with `params` bound (see `sql`).
+
+        Returns the connection, to fetch the result from in any form
+        (`fetchnumpy`, `fetch_arrow_table`, ...).
+        """
+        return self.conn.execute(sql, _bindable(params))
+
+
+    def sql(self,
+            sql: str,
+            params: Optional[Union[Sequence[Any], Dict[str, Any]]] = None,
+            format: str = 'pandas',
+            ) -> Any:
+        """Run SQL and return the results.
+
+        Values are best passed as `params`, bound to `?` (a sequence)
+        or `$name` (a dict) placeholders, rather than formatted into
+        the SQL: they need no quoting, and the statement text stays
+        the same for every call.
+
+        `format` sets the type of the result: 'pandas' (a DataFrame),
+        'arrow' (a `pyarrow.Table`), 'numpy' (a dict of column
+        arrays) or 'polars' (a polars DataFrame, if installed). All
+        but 'pandas' skip the conversion to pandas objects.
+        """
+        if format not in self.RESULT_FORMATS:
+            raise ValueError(f"Unknown result format {format}")
+
+        result = self.conn.sql(sql, params=_bindable(params))
 
         if result is None:
-            # empty dataframe in the case
-            # the query returns nothing
-            return pd.DataFrame([])
+            # the query returns nothing - an empty result
+            return self._empty_result(format)
+        if format == 'arrow':
+            return result.fetch_arrow_table()
+        if format == 'numpy':
+            return result.fetchnumpy()
+        if format == 'polars':
+            return result.pl()
         return result.df()
 
+    def stream(self,
+               sql: str,
+               params: Optional[Union[Sequence[Any], Dict[str, Any]]] = None,
+               batch_size: int = 1_000_000,
+               format: str = 'arrow',
+               ) -> Iterator[Any]:
+        """Run SQL and yield the results in batches of `batch_size` rows.
+
+        Batches are Arrow record batches, or DataFrames with format
+        'pandas'; only one batch is held in memory at a time. The
+        query runs on its own cursor, so the connection can be used
+        while iterating.
+        """
+        if format not in ['arrow', 'pandas']:
+            raise ValueError(f"Unknown stream format {format}")
+
+        cursor = self.conn.cursor()
+        try:
+            if self.read_only and self.storage_mode() == 'parquet':
+                # the temporary expr view (see `_open_expr_view`) is
+                # only seen by the connection that created it
+                cursor.execute(f"""
+                    CREATE OR REPLACE TEMP VIEW expr AS
+                    {self._expr_view_source()}""")
+            reader = cursor.execute(sql, _bindable(params)).fetch_record_batch(
+                batch_size)
+            for batch in reader:
+                yield batch if format == 'arrow' else batch.to_pandas()
+        finally:
+            cursor.close()
+
+
+    def export(self, sql: str, path: str) -> None:
+        """Write the result of a query to a Parquet or CSV file.
+
+        The rows are written by DuckDB (COPY), they never pass through
+        Python. The file type follows from the suffix of `path`.
+        """
+        suffix = Path(path).suffix.lower()
+        options = {'.parquet': "FORMAT parquet",
+                   '.csv': "FORMAT csv, HEADER",
+                   '.tsv': "FORMAT csv, HEADER, DELIMITER '\\t'"}
+        if suffix not in options:
+            raise ValueError(f"Cannot export to {suffix} files")
+        self.execute(
+            f"COPY ({sql}) TO {_literal(path)} ({options[suffix]})")
+
+
+    def _empty_result(self, format: str) -> Any:
+        """An empty result, in one of the RESULT_FORMATS."""
+        if format == 'arrow':
+            import pyarrow as pa
+            return pa.table({})
+        if format == 'numpy':
+            return {}
+        if format == 'polars':
+            import polars as pl
+            return pl.DataFrame()
+        import pandas as pd
+        return pd.DataFrame([])
+
     def get_id(self,
                table: str,
                field: str,
                value: Any
                ) -> int:
         """
-        This function auto-increments an ID in a specific field of a
-        database table.
+        Return the ID belonging to a value, or allocate a new one.
 
         Parameters:
         table (str): The name of the table in the database to interact
             with.
-        field (str): The specific field within the table to increment.
+        field (str): The specific field within the table; ids are kept
+            in `{field}_id`.
         value (str): The value to search for within the chosen field.
 
-        The function first tries to select the ID related to the
-        provided value in the specified field. If it exists, the
-        function will return this ID.
-
-        If the table doesn't exist or there's no record corresponding to
-        the provided value, the function then tries to retrieve the
-        maximum ID in the mentioned field and returns this ID
-        incremented by 1. If the table still does not exist, it will
-        return 1 (0 + 1) as the new ID to use.
+        If a record with `value` in `field` exists, its ID is
+        returned. Otherwise a new ID is taken from a duckdb sequence
+        (`seq_{table}_{field}_id`). The sequence is created on first
+        use, starting after the highest ID in the table, if any.
 
         Returns:
-        int: The ID to use next in the field.
+        int: The ID to use for this value.
         """
 
         import duckdb
         try:
-            sql = f"""SELECT DISTINCT {field}_id
+            sql = f"""SELECT {field}_id
                         FROM {table}
-                       WHERE {field} = '{value}' """
-            result = self.sql(sql)
+                       WHERE {field} = ?
+                       LIMIT 1 """
+            result = self.sql(sql, [value])
 
             if len(result) > 0:
                 return result.iloc[0,0]
@@ -151,75 +309,120 @@ class CHDB:
             # table does not exist?
             pass
 
-        # no record
-        try:
-            max_id = self.sql(
-                f'''SELECT MAX({field}_id)
-                    FROM {table}''').iloc[0,0]
-        except duckdb.CatalogException:
-            # table does not exist?
-            max_id = 0
-        return max_id + 1
+        # no record - allocate a new id
+        seq = f"seq_{table}_{field}_id"
+        exists = self.sql("""
+            SELECT COUNT(*) FROM duckdb_sequences()
+             WHERE sequence_name = ? """, [seq]).iloc[0, 0]
+        if not exists:
+            try:
+                max_id = self.sql(
+                    f'''SELECT COALESCE(MAX({field}_id), 0)
+                        FROM {table}''').iloc[0,0]
+            except duckdb.CatalogException:
+                # table does not exist?
+                max_id = 0
+            self.execute(
+                f"CREATE SEQUENCE {seq} START WITH {int(max_id) + 1}")
+
+        return int(self.sql(f"SELECT nextval('{seq}')").iloc[0, 0])
 
 
     def import_count_table(self,
                            dataset_id: int,
                            adata: "AnnData",
                            layer: str,
-                           chunksize: int = 50000,
+                           chunksize: int = DEFAULT_CHUNKSIZE,
+                           h5file: Optional["h5py.File"] = None,
+                           dtype: str = 'float32',
+                           step: float = 0,
                            ) -> None:
-        """Import an adata count matrix."""
-        conn = self.conn
+        """Import an adata count matrix.
+
+        Only nonzero entries are stored. The matrix is never
+        densified; it is walked in chunks of at most `chunksize`
+        nonzero entries. If `h5file` is given, the matrix is streamed
+        from that file rather than taken from `adata`.
+
+        Values are converted to `dtype` (see `ingest.value_dtype`),
+        optionally quantized to multiples of `step`.
+        """
+        import numpy as np
+
+        from .ingest import compact_values, get_matrix, iter_nonzero
 
         lg.info("Start storing expression matrix")
         lg.info(f"Processing layer {layer}")
 
-        if layer == 'X':
-            x = adata.to_df()
-        elif layer == 'RAW':
-            x = adata.raw.to_adata().to_df()
-        else:
-            x = adata.to_df(layer=layer)
-
-        # chunk this - using too much memory:
-        x.index.name = 'obs'
-        x.columns.name = 'gene'
+        matrix, obs_names, var_names = get_matrix(adata, layer, h5file)
 
-        #if normalize == 'logrpm':
-        #    x = np.log1p(10000 * x.copy().divide(x.sum(1), axis=0))
+        # cells & genes are stored once, expression rows only carry
+        # their integer ids
+        self.store_dims(dataset_id, obs_names, var_names)
+        self.store_value_dtype(dataset_id, dtype, step)
+        self.create_expr_table()
 
+        if self.storage_mode() == 'parquet':
+            self._import_count_partition(
+                dataset_id, matrix, chunksize, dtype, step)
+            self.bump_generation(f'dataset/{dataset_id}')
+            return
 
         #remove old data
         lg.info("remove old data")
-        if self.table_exists('expr'):
-            sql = f"""
-                DELETE FROM expr
-                 WHERE dataset_id={dataset_id}"""
-            conn.sql(sql)
+        self.execute("""
+            DELETE FROM expr
+             WHERE dataset_id = ?""", [dataset_id])
 
         lg.info("start expression data upload")
-        for ic in range(0, x.shape[0], chunksize):
-            chunk = x.iloc[ic:ic+chunksize,:]
-            # chunk_rnk = rnk.iloc[ic:ic+chunksize,:]
-
-            melted = chunk.reset_index().melt(id_vars='obs')
-            melted['value'] = melted['value'].astype(float)  # ensure!
-            melted['dataset_id'] = dataset_id
-
-            # melted_rnk = chunk.reset_index().melt(id_vars='obs', value_name='rank')
-            # melted_rnk['rank'] = melted_rnk['rank'].astype(float)  # ensure!
-
-            # to be sure!
-            # assert melted[['obs', 'gene']].equals(melted_rnk[['obs', 'gene']])
-            # melted['rank'] = melted_rnk['rank']
-
-            lg.info(f"chunk {ic}/{x.shape[0]} - melt {melted.shape[0]:_d}")
-            self.create_or_append('expr', melted)
+        stored = 0
+        for rows, cols, values in iter_nonzero(matrix, chunksize):
+            self.bulk_append('expr', {
+                'dataset_id': dataset_id,
+                'cell_id': rows.astype(np.int32),
+                'gene_id': cols.astype(np.int32),
+                'value': compact_values(values, dtype, step)})
+            stored += len(values)
+            lg.info(f"stored {stored:_d} nonzero values")
+        self.bump_generation(f'dataset/{dataset_id}')
 
         # ensure index
         # print(db.raw_sql('create index idx_expr_eg on expr (exp_id, gene)'))
 
 
+    def _import_count_partition(self,
+                                dataset_id: int,
+                                matrix: Any,
+                                chunksize: int,
+                                dtype: str,
+                                step: float) -> None:
+        """Write a matrix to the Parquet partition of a dataset."""
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        from .ingest import compact_values, iter_nonzero
+
+        staging = self._stage_partition(dataset_id)
+        writer = None
+        stored = 0
+        for rows, cols, values in iter_nonzero(matrix, chunksize):
+            chunk = pa.table({
+                'cell_id': rows.astype(np.int32),
+                'gene_id': cols.astype(np.int32),
+                'value': compact_values(
+                    values, dtype, step).astype(np.float32)})
+            if writer is None:
+                writer = pq.ParquetWriter(
+                    str(staging / 'data.parquet'), chunk.schema)
+            writer.write_table(chunk)
+            stored += len(values)
+            lg.info(f"stored {stored:_d} nonzero values")
+        if writer is not None:
+            writer.close()
+        self._swap_partition(dataset_id, staging)
+
+
     def _check_incoming_df(self,
                            local_df: Union["pd.DataFrame", "pd.Series", dict],
                            ) -> "pd.DataFrame":
@@ -242,34 +445,355 @@ class CHDB:
                      dtype: str,
                      exp_id: str):
         """Store an obs/obsm columns."""
+        self.store_obs(exp_id, col.index, {name: (col.to_numpy(), dtype)})
+
+
+    def upgrade_obs_tables(self) -> None:
+        """Drop obs tables written by older versions.
+
+        These were keyed by cell name, with categories stored as
+        strings. Their fingerprints are removed as well, so the next
+        upload stores the columns again.
+        """
+        for table in ['obs_cat', 'obs_num']:
+            if not self.table_exists(table):
+                continue
+            cols = self.sql(f"DESCRIBE {table}")['column_name']
+            if 'cell' not in set(cols):
+                continue
+            lg.warning(f"dropping old style {table}, re-upload to restore")
+            self.execute(f"DROP TABLE {table}")
+            if self.table_exists('fingerprint'):
+                self.execute("""
+                    DELETE FROM fingerprint
+                     WHERE key LIKE 'obs/%' OR key LIKE 'obsm/%'""")
+
+
+    def upgrade_expr_table(self) -> None:
+        """Drop an expr table written by older versions.
+
+        This was keyed by cell & gene name, and cannot take the rows
+        of the current layout. The layer fingerprints are removed as
+        well, so the next upload stores the layers again.
+        """
+        if not self.table_exists('expr'):
+            return
+        cols = self.sql("DESCRIBE expr")['column_name']
+        if 'obs' not in set(cols):
+            return
+        lg.warning("dropping old style expr, re-upload to restore")
+        with self.transaction():
+            self.execute("DROP TABLE expr")
+            if self.table_exists('fingerprint'):
+                self.execute("""
+                    DELETE FROM fingerprint
+                     WHERE key LIKE 'layer/%'""")
+
+
+    def store_obs(self,
+                  exp_id: int,
+                  obs_names: Sequence[str],
+                  columns: Dict[str, Tuple[Any, str]],
+                  obsm: Optional[Dict[str, Any]] = None,
+                  fingerprints: Optional[Dict[str, str]] = None) -> None:
+        """Store many obs columns (and obsm blocks) of an experiment at once.
+
+        `columns` maps column names to (values, dtype), with dtype one
+        of 'cat', 'int', 'bool' or 'float'. Categorical columns are
+        stored as integer codes (obs_cat) plus their levels
+        (obs_cat_levels), integers in obs_int, booleans as BOOLEAN
+        (obs_bool) and floats as DOUBLE (obs_num). obs_int is BIGINT,
+        which duckdb bit-packs to the range of the values; the NumPy
+        width of each integer column is kept in obs_dtype, so it is
+        read back as it was. Cells are referred to by cell_id (see
+        `store_obs_dim`). Each
+        table is updated with one delete and one bulk insert. All of
+        it, the `obsm` blocks (see `store_obsm`) and the
+        `fingerprints` of what is stored go in a single transaction.
+        """
+        import numpy as np
+        import pandas as pd
+        import pyarrow as pa
+
+        for table, vtype in [('obs_cat', 'code INTEGER'),
+                             ('obs_int', 'value BIGINT'),
+                             ('obs_bool', 'value BOOLEAN'),
+                             ('obs_num', 'value DOUBLE')]:
+            self.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    exp_id INTEGER,
+                    name VARCHAR,
+                    cell_id INTEGER,
+                    {vtype})""")
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS obs_cat_levels (
+                exp_id INTEGER,
+                name VARCHAR,
+                code INTEGER,
+                level VARCHAR)""")
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS obs_dtype (
+                exp_id INTEGER,
+                name VARCHAR,
+                dtype VARCHAR)""")
+
+        n_cells = len(obs_names)
+
+        # table -> [(name, values)]
+        tables: Dict[str, List[Tuple[str, Any]]] = dict(
+            obs_cat=[], obs_int=[], obs_bool=[], obs_num=[],
+            obs_cat_levels=[])
+        # native width of the integer columns
+        int_dtypes: Dict[str, str] = {}
+        for name, (values, dtype) in columns.items():
+            if dtype == 'cat':
+                cat = pd.Categorical(values)
+                tables['obs_cat'].append(
+                    (name, np.asarray(cat.codes, dtype=np.int32)))
+                tables['obs_cat_levels'].append(
+                    (name, np.asarray(cat.categories.astype(str),
+                                      dtype=str)))
+            elif dtype == 'int':
+                series = pd.Series(values)
+                int_dtypes[name] = 'int64'
+                if pd.api.types.is_integer_dtype(series.dtype):
+                    # Int16 (nullable) is stored as int16
+                    int_dtypes[name] = series.dtype.name.lower()
+                # keeps missing values of nullable integer columns
+                tables['obs_int'].append(
+                    (name, pa.array(series.astype('Int64'))))
+            elif dtype == 'bool':
+                tables['obs_bool'].append(
+                    (name, pa.array(pd.Series(values).astype('boolean'))))
+            elif dtype in ['float', 'dimred']:
+                tables['obs_num'].append(
+                    (name, np.asarray(values, dtype=float)))
+            else:
+                raise ValueError(f"Unknown dtype {dtype}")
+
+        with self.transaction():
+            self.store_obs_dim(exp_id, obs_names)
+            for table, cols in tables.items():
+                if len(cols) == 0:
+                    continue
+                names = [name for name, _ in cols]
+                lg.info(f"storing {len(names)} columns in {table}")
+
+                # ensure old data is gone
+                self.execute(f"""
+                    DELETE FROM {table}
+                     WHERE exp_id = ?
+                       AND name IN (SELECT unnest(?))""", [exp_id, names])
+
+                lengths = [len(values) for _, values in cols]
+                parts = [values for _, values in cols]
+                if table == 'obs_cat_levels':
+                    rows = {'code': np.concatenate(
+                                [np.arange(n, dtype=np.int32)
+                                 for n in lengths]),
+                            'level': np.concatenate(parts)}
+                else:
+                    column = 'code' if table == 'obs_cat' else 'value'
+                    rows = {'cell_id': np.tile(
+                                np.arange(n_cells, dtype=np.int32),
+                                len(cols)),
+                            column: (pa.concat_arrays(parts)
+                                     if table in ('obs_int', 'obs_bool')
+                                     else np.concatenate(parts))}
+
+                # long format: all rows of the first column, then
+                # all of the second...
+                self.bulk_append(table, {
+                    'exp_id': exp_id,
+                    'name': pa.DictionaryArray.from_arrays(
+                        np.repeat(np.arange(len(cols), dtype=np.int32),
+                                  lengths), pa.array(names)),
+                    **rows})
+            if int_dtypes:
+                self.execute("""
+                    DELETE FROM obs_dtype
+                     WHERE exp_id = ?
+                       AND name IN (SELECT unnest(?))""",
+                    [exp_id, list(int_dtypes)])
+                self.bulk_append('obs_dtype', {
+                    'exp_id': exp_id,
+                    'name': np.asarray(list(int_dtypes), dtype=str),
+                    'dtype': np.asarray(list(int_dtypes.values()),
+                                        dtype=str)})
+            if obsm:
+                self._store_obsm_blocks(exp_id, obsm)
+            for key, hash in (fingerprints or {}).items():
+                self.set_fingerprint(key, hash)
+            self.bump_generation(f'exp/{exp_id}')
+
+
+    def store_obs_dim(self,
+                      exp_id: int,
+                      obs_names: Sequence[str]) -> None:
+        """Store the cell names of an experiment (obs_dim).
+
+        obs & obsm rows refer to cells by their position in
+        `obs_names` - the same cell_id used in cell_dim.
+        """
+        import numpy as np
+
+        if self.table_exists('obs_dim'):
+            self.execute("""
+                DELETE FROM obs_dim
+                 WHERE exp_id = ?""", [exp_id])
+        self.bulk_append('obs_dim', {
+            'exp_id': exp_id,
+            'cell_id': np.arange(len(obs_names), dtype=np.int32),
+            'obs': np.asarray(obs_names, dtype=str)})
+
+
+    def store_obsm(self,
+                   exp_id: int,
+                   obs_names: Sequence[str],
+                   blocks: Dict[str, Any]) -> None:
+        """Store embeddings (obsm blocks) of an experiment.
+
+        `blocks` maps names to (cells x dims) arrays. Each cell gets one
+        row in the obsm table, with all dimensions in a FLOAT[] list.
+        """
+        self.store_obs(exp_id, obs_names, {}, obsm=blocks)
+
+
+    def _store_obsm_blocks(self,
+                           exp_id: int,
+                           blocks: Dict[str, Any]) -> None:
+        import numpy as np
+        import pyarrow as pa
+
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS obsm (
+                exp_id INTEGER,
+                name VARCHAR,
+                cell_id INTEGER,
+                coords FLOAT[])""")
+
+        for name, block in blocks.items():
+            block = np.ascontiguousarray(block, dtype=np.float32)
+            n_cells, n_dims = block.shape
+            lg.info(f"storing obsm {name}: {n_dims} dimensions")
+            self.execute("""
+                DELETE FROM obsm
+                 WHERE exp_id = ?
+                   AND name = ?""", [exp_id, name])
+            if self.table_exists('obs_num'):
+                # dimensions stored by older versions
+                self.execute("""
+                    DELETE FROM obs_num
+                     WHERE exp_id = ?
+                       AND starts_with(name, ?)""",
+                    [exp_id, f'{name}/'])
+            offsets = np.arange(0, n_cells * n_dims + 1, n_dims,
+                                dtype=np.int32)
+            self.bulk_append('obsm', {
+                'exp_id': exp_id,
+                'name': name,
+                'cell_id': np.arange(n_cells, dtype=np.int32),
+                'coords': pa.ListArray.from_arrays(
+                    offsets, block.ravel())})
+
+
+    def upload_job_done(self,
+                        path: str,
+                        size: int,
+                        mtime: float) -> bool:
+        """Was this file (unchanged since) uploaded successfully?"""
+        if not self.table_exists('upload_job'):
+            return False
+        rv = self.sql("""
+            SELECT status, size, mtime
+              FROM upload_job
+             WHERE path = ? """, [str(path)])
+        if len(rv) == 0:
+            return False
+        job = rv.iloc[0]
+        return (job['status'] == 'done'
+                and job['size'] == size
+                and job['mtime'] == mtime)
+
+
+    def set_upload_job(self,
+                       path: str,
+                       size: int,
+                       mtime: float,
+                       status: str,
+                       message: str = '') -> None:
+        """Record the state of a file upload in the upload_job table."""
         import pandas as pd
 
-        col.index.name = 'cell'
-        col.name = 'value'
+        job = pd.DataFrame(dict(
+            path=[str(path)], size=[int(size)], mtime=[float(mtime)],
+            status=[status], message=[message],
+            updated=[pd.Timestamp.now()]))
+        self.uac('upload_job', job, ukey='path')
 
-        d = pd.DataFrame(col).reset_index()
-        d['name'] = name
-        d['exp_id'] = exp_id
 
-        if dtype == 'cat':
-            d['value'] = d['value'].astype(str)
-            table = 'obs_cat'
+    def get_fingerprint(self, key: str) -> Optional[str]:
+        """Return the stored content hash of an uploaded part, if any."""
+        if not self.table_exists('fingerprint'):
+            return None
+        rv = self.sql("""
+            SELECT hash FROM fingerprint
+             WHERE key = ? """, [key])
+        if len(rv) == 0:
+            return None
+        return str(rv.iloc[0, 0])
 
-        elif dtype in ['int', 'float', 'dimred']:
-            d['value'] = d['value'].astype(float)
-            table = 'obs_num'
-        else:
-            raise ValueError(f"Unknown dtype {dtype}")
 
-        # ensure old data is gone
-        if self.table_exists(table):
-            self.conn.sql(f"""
-                DELETE from {table}
-                 WHERE name = '{name}'
-                   AND exp_id = '{exp_id}'
-            """)
+    def set_fingerprint(self, key: str, hash: str) -> None:
+        """Store the content hash of an uploaded part.
 
-        self.create_or_append(table=table, local_df=d)
+        Keys look like 'layer/<dataset_id>', 'obs/<exp_id>/<column>' or
+        'obsm/<exp_id>/<name>'.
+        """
+        import pandas as pd
+        self.uac('fingerprint',
+                 pd.DataFrame(dict(key=[key], hash=[hash])),
+                 ukey='key')
+
+
+    def generation(self, key: str) -> int:
+        """Return the generation of a part of the database.
+
+        Keys are 'dataset/<dataset_id>' (expression data),
+        'exp/<exp_id>' (obs & obsm) and 'experiment_md'. Each write to
+        such a part bumps its generation (see `bump_generation`), so
+        results cached for an older generation are known to be stale.
+
+        A read-only connection keeps the database locked against
+        writers, so there generations are only read once.
+        """
+        import duckdb
+
+        if self.read_only and key in self._generations:
+            return self._generations[key]
+        try:
+            rv = self.execute("""
+                SELECT gen FROM generation
+                 WHERE key = ?""", [key]).fetchone()
+        except duckdb.CatalogException:
+            # nothing written since generations were introduced
+            rv = None
+        gen = 0 if rv is None else int(rv[0])
+        if self.read_only:
+            self._generations[key] = gen
+        return gen
+
+
+    def bump_generation(self, key: str) -> None:
+        """Mark a part of the database as changed (see `generation`)."""
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS generation (
+                key VARCHAR PRIMARY KEY,
+                gen BIGINT)""")
+        self.execute("""
+            INSERT INTO generation VALUES (?, 1)
+                ON CONFLICT (key) DO UPDATE SET gen = generation.gen + 1
+            """, [key])
 
 
     def uac_experiment_md(self,
@@ -297,10 +821,21 @@ class CHDB:
             else:
                 expdata[col] = int(expdata[col])
 
-        return self.uac(
+        self.uac(
             table = 'experiment_md',
             local_df = expdata,
             ukey = 'dataset')
+        self.bump_generation('experiment_md')
+
+
+    def has_primary_key(self, table: str, column: str) -> bool:
+        """Check if `column` (alone) is the primary key of a table."""
+        rv = self.sql("""
+            SELECT COUNT(*) FROM duckdb_constraints()
+             WHERE table_name = ?
+               AND constraint_type = 'PRIMARY KEY'
+               AND constraint_column_names = [?]""", [table, column])
+        return bool(rv.iloc[0, 0])
 
 
     def uac(self,
@@ -312,29 +847,557 @@ class CHDB:
 
         Name is from Update Append Create
 
+        New tables get `ukey` as primary key, and all records are
+        upserted with a single INSERT OR REPLACE. Tables without that
+        primary key (created by older versions) fall back to one
+        DELETE & one INSERT for the whole batch, in one transaction.
         """
 
-        import pandas as pd
-
         local_df = self._check_incoming_df(local_df)
+        # last record wins
+        local_df = local_df.drop_duplicates(subset=ukey, keep='last')
+        self.conn.register('uac_df', local_df)
+
         if not self.table_exists(table):
-            return self.create_or_append(table, local_df)
+            self.execute(f"""
+                CREATE TABLE '{table}' AS
+                SELECT * FROM uac_df LIMIT 0""")
+            self.execute(
+                f'ALTER TABLE "{table}" ADD PRIMARY KEY ("{ukey}")')
+
+        try:
+            if self.has_primary_key(table, ukey):
+                self.execute(f"""
+                    INSERT OR REPLACE INTO '{table}' BY NAME
+                    SELECT * FROM uac_df""")
+            else:
+                with self.transaction():
+                    self.execute(f"""
+                        DELETE FROM '{table}'
+                         WHERE "{ukey}" IN (SELECT "{ukey}" FROM uac_df)""")
+                    self.execute(f"""
+                        INSERT INTO '{table}' BY NAME
+                        SELECT * FROM uac_df""")
+        finally:
+            self.conn.unregister('uac_df')
+
+
+    def storage_mode(self) -> str:
+        """Where expression data is stored: 'table' or 'parquet'.
+
+        In 'table' mode, expr is a table in the database file. In
+        'parquet' mode, each dataset has its own Parquet partition in
+        `expr_dir` (expr_dir/dataset_id=N/*.parquet) and expr is a
+        view on these.
+        """
+        if not self.table_exists('config'):
+            return 'table'
+        rv = self.sql("SELECT value FROM config WHERE key = 'storage'")
+        return 'table' if len(rv) == 0 else str(rv.iloc[0, 0])
+
+
+    @property
+    def expr_dir(self) -> Path:
+        """Directory with the Parquet partitions of expr."""
+        return Path(self.dbfile).absolute().with_suffix('.expr')
+
+
+    def set_storage_mode(self, mode: str) -> None:
+        """Switch the storage mode, moving existing expression data."""
+        import shutil
+
+        import pandas as pd
+
+        if mode not in ['table', 'parquet']:
+            raise ValueError(f"Unknown storage mode {mode}")
+        current = self.storage_mode()
+        if mode == current:
+            return
+        lg.info(f"switch storage mode from {current} to {mode}")
+
+        if mode == 'parquet':
+            if self.table_exists('expr'):
+                self._move_expr_to_partitions()
+                self.execute("DROP TABLE expr")
+        else:
+            self.execute("""
+                CREATE TABLE expr_table AS SELECT * FROM expr""")
+            self.execute("DROP VIEW expr")
+            self.execute("ALTER TABLE expr_table RENAME TO expr")
+
+        self.uac('config',
+                 pd.DataFrame(dict(key=['storage'], value=[mode])),
+                 'key')
+        if mode == 'parquet':
+            self.refresh_expr_view()
+        else:
+            shutil.rmtree(self.expr_dir, ignore_errors=True)
 
-        for _, row in local_df.iterrows():
-            # delete (if exists)
-            sql = f'''
-                DELETE FROM {table}
-                 WHERE "{ukey}" = '{row[ukey]}'
-            '''
-            self.conn.sql(sql)
 
-        # & insert
-        sql = f'''
-            INSERT INTO '{table}'
-            SELECT * FROM local_df
-        '''
+    def _move_expr_to_partitions(self) -> None:
+        """Write the expr table to Parquet partitions, in one pass.
+
+        Each dataset_id=N directory written is swapped in as the
+        partition of that dataset (see `copy_partition`).
+        """
+        import shutil
+
+        staging = self.expr_dir / ".expr.new"
+        shutil.rmtree(staging, ignore_errors=True)
+        self.expr_dir.mkdir(parents=True, exist_ok=True)
+        self.execute(f"""
+            COPY (SELECT CAST(dataset_id AS INTEGER) AS dataset_id,
+                         CAST(cell_id AS INTEGER) AS cell_id,
+                         CAST(gene_id AS INTEGER) AS gene_id,
+                         CAST(value AS FLOAT) AS value
+                    FROM expr)
+              TO {_literal(staging)}
+                 (FORMAT parquet, PARTITION_BY (dataset_id))""")
+        for partition in sorted(staging.glob('dataset_id=*')):
+            dataset_id = int(partition.name.split('=')[1])
+            self._swap_partition(dataset_id, partition)
+        shutil.rmtree(staging)
+
+
+    def _open_expr_view(self) -> None:
+        """Point the expr view at `expr_dir`, where it is now.
+
+        The view holds an absolute path, so it is recreated whenever
+        the database is opened - the database & its expr directory
+        may have been moved. A read-only connection gets a temporary
+        view, which shadows the stored one.
+        """
+        if self.storage_mode() == 'parquet':
+            self.refresh_expr_view(temp=self.read_only)
+
+
+    def refresh_expr_view(self, temp: bool = False) -> None:
+        """(Re)create the expr view on the Parquet partitions."""
+        is_table = self.sql("""
+            SELECT COUNT(*) FROM information_schema.tables
+             WHERE table_name = 'expr'
+               AND table_type = 'BASE TABLE'""").iloc[0, 0]
+        if is_table:
+            # still being moved to parquet, see `set_storage_mode`
+            return
+
+        temp = "TEMP" if temp else ""
+        self.execute(f"""
+            CREATE OR REPLACE {temp} VIEW expr AS
+            {self._expr_view_source()}""")
+
+
+    def _expr_view_source(self) -> str:
+        """The query behind the expr view."""
+        partitions = _literal(f"{self.expr_dir}/dataset_id=*/*.parquet")
+        if any(self.expr_dir.glob('dataset_id=*/*.parquet')):
+            return f"""
+                SELECT dataset_id, cell_id, gene_id, value
+                  FROM read_parquet({partitions},
+                                    hive_partitioning = true,
+                                    hive_types = {{'dataset_id': INTEGER}})"""
+        # no data yet - an empty view with the right columns
+        return """
+            SELECT NULL::INTEGER AS dataset_id,
+                   NULL::INTEGER AS cell_id,
+                   NULL::INTEGER AS gene_id,
+                   NULL::FLOAT AS value
+             WHERE false"""
+
+
+    def _stage_partition(self, dataset_id: int) -> Path:
+        """Empty directory to write a new partition of a dataset to."""
+        import shutil
+
+        staging = self.expr_dir / f".dataset_id={dataset_id}.new"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        return staging
+
+
+    def _swap_partition(self,
+                        dataset_id: int,
+                        staging: Optional[Path]) -> None:
+        """Replace the partition of a dataset by a staged one.
+
+        Without `staging`, the partition is dropped.
+        """
+        import shutil
+
+        final = self.expr_dir / f"dataset_id={dataset_id}"
+        old = self.expr_dir / f".dataset_id={dataset_id}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        if final.exists():
+            final.rename(old)
+        if staging is not None:
+            staging.rename(final)
+        shutil.rmtree(old, ignore_errors=True)
+        self.refresh_expr_view()
+
+
+    def copy_partition(self,
+                       dataset_id: int,
+                       select: str,
+                       params: Optional[Sequence[Any]] = None) -> None:
+        """Write the partition of a dataset from a query.
+
+        `select` should return cell_id, gene_id & value columns, with
+        `params` bound to its placeholders.
+        """
+        staging = self._stage_partition(dataset_id)
+        self.execute(f"""
+            COPY (SELECT CAST(cell_id AS INTEGER) AS cell_id,
+                         CAST(gene_id AS INTEGER) AS gene_id,
+                         CAST(value AS FLOAT) AS value
+                    FROM ({select}))
+              TO {_literal(staging / 'data.parquet')} (FORMAT parquet)""",
+            params)
+        self._swap_partition(dataset_id, staging)
+
+
+    def create_expr_table(self) -> None:
+        """Create the expr table, if it does not exist yet.
+
+        Values are stored as FLOAT: exact for counts up to 2**24 and
+        compact for the (quantized) normalized layers. The per-dataset
+        dtype is kept in the value_dtype table; count layers with
+        larger values are recorded as float32 (see
+        `ingest.value_dtype`). In 'parquet' storage mode, the expr view
+        is created instead.
+        """
+        if self.storage_mode() == 'parquet':
+            if not self.table_exists('expr'):
+                self.refresh_expr_view()
+            return
+        self.upgrade_expr_table()
+        self.execute("""
+            CREATE TABLE IF NOT EXISTS expr (
+                dataset_id INTEGER,
+                cell_id INTEGER,
+                gene_id INTEGER,
+                value FLOAT)""")
+
+
+    def store_value_dtype(self,
+                          dataset_id: int,
+                          dtype: str,
+                          step: float = 0) -> None:
+        """Record the value dtype (& quantization step) of a dataset."""
+        import pandas as pd
+
+        self.uac('value_dtype', pd.DataFrame(dict(
+            dataset_id=[int(dataset_id)], dtype=[dtype],
+            step=[float(step)])), ukey='dataset_id')
+
+
+    def value_dtype(self, dataset_id: int) -> str:
+        """Return the NumPy dtype the values of a dataset are stored in."""
+        if not self.table_exists('value_dtype'):
+            return 'float64'
+        rv = self.sql("""
+            SELECT dtype FROM value_dtype
+             WHERE dataset_id = ?""", [dataset_id])
+        if len(rv) == 0:
+            return 'float64'
+        return str(rv.iloc[0, 0])
+
+
+    def store_dims(self,
+                   dataset_id: int,
+                   obs_names: Sequence[str],
+                   var_names: Sequence[str]) -> None:
+        """Store the cell & gene names of a dataset.
+
+        Rows in `expr` refer to cells and genes by their position in
+        `obs_names` (cell_dim.cell_id) and `var_names`
+        (gene_dim.gene_id). As `expr` holds only nonzero values, the
+        number of cells & genes is recorded in dataset_shape. Packed
+        vectors of the dataset (see `pack_expr`) are dropped.
+        """
+        import numpy as np
+        import pandas as pd
+
+        self.drop_packed([dataset_id])
+        self.bump_generation(f'dataset/{dataset_id}')
+
+        self.uac('dataset_shape', pd.DataFrame(dict(
+            dataset_id=[int(dataset_id)],
+            n_cells=[len(obs_names)],
+            n_genes=[len(var_names)])), ukey='dataset_id')
+
+        dims = [('cell_dim', 'cell_id', 'obs', obs_names),
+                ('gene_dim', 'gene_id', 'gene', var_names)]
+        for table, id_col, name_col, names in dims:
+            if self.table_exists(table):
+                self.execute(f"""
+                    DELETE FROM {table}
+                     WHERE dataset_id = ?""", [dataset_id])
+            self.bulk_append(table, {
+                'dataset_id': dataset_id,
+                id_col: np.arange(len(names), dtype=np.int32),
+                name_col: np.asarray(names, dtype=str)})
+
+
+    def cluster_expr(self,
+                     dataset_ids: Optional[Sequence[int]] = None,
+                     ) -> None:
+        """Rewrite expr with rows ordered by dataset, gene & cell.
+
+        DuckDB keeps min/max statistics per row group (zone maps);
+        with the rows of a gene close together, a single-gene lookup
+        skips almost all row groups. Without `dataset_ids` the whole
+        table is rewritten, otherwise only the rows of these datasets
+        (which then end up at the end of the table). In 'parquet'
+        storage mode, the partitions are rewritten.
+        """
+        if self.storage_mode() == 'parquet':
+            if dataset_ids is None:
+                dataset_ids = sorted(
+                    int(d.name.split('=')[1])
+                    for d in self.expr_dir.glob('dataset_id=*'))
+            for dataset_id in dataset_ids:
+                lg.info(f"cluster partition of dataset {dataset_id}")
+                partition = self.expr_dir / f"dataset_id={dataset_id}"
+                self.copy_partition(dataset_id, """
+                    SELECT cell_id, gene_id, value
+                      FROM read_parquet(?)
+                     ORDER BY gene_id, cell_id""",
+                    [f"{partition}/*.parquet"])
+            return
+
+        order = "ORDER BY dataset_id, gene_id, cell_id"
+        with self.transaction():
+            if dataset_ids is None:
+                lg.info("rewrite expr, clustered by dataset & gene")
+                self.execute(f"""
+                    CREATE TABLE expr_clustered AS
+                    SELECT * FROM expr {order}""")
+                self.execute("DROP TABLE expr")
+                self.execute(
+                    "ALTER TABLE expr_clustered RENAME TO expr")
+            else:
+                lg.info(f"cluster expr of datasets {list(dataset_ids)}")
+                self.execute(f"""
+                    CREATE TEMP TABLE expr_clustered AS
+                    SELECT * FROM expr
+                     WHERE dataset_id IN (SELECT unnest(?))
+                     {order}""", [dataset_ids])
+                self.execute("""
+                    DELETE FROM expr
+                     WHERE dataset_id IN (SELECT unnest(?))""",
+                    [dataset_ids])
+                self.execute(
+                    "INSERT INTO expr SELECT * FROM expr_clustered")
+                self.execute("DROP TABLE expr_clustered")
+        if not self._in_transaction:
+            # write out the new row groups & free the old ones
+            self.execute("CHECKPOINT")
+
+
+    # packed tables: (table, key column, index column, shape column)
+    PACKED_TABLES = [('gene_packed', 'gene_id', 'cell_id', 'n_genes'),
+                     ('cell_packed', 'cell_id', 'gene_id', 'n_cells')]
+
+
+    def drop_packed(self, dataset_ids: Sequence[int]) -> None:
+        """Remove the packed vectors of datasets (see `pack_expr`)."""
+        if len(dataset_ids) == 0:
+            return
+        for table, *_ in self.PACKED_TABLES:
+            if self.table_exists(table):
+                self.execute(f"""
+                    DELETE FROM {table}
+                     WHERE dataset_id IN (SELECT unnest(?))""",
+                    [dataset_ids])
+
+
+    def pack_expr(self,
+                  dataset_ids: Optional[Sequence[int]] = None,
+                  chunksize: int = DEFAULT_CHUNKSIZE,
+                  ) -> None:
+        """Build packed per-gene & per-cell vectors of datasets.
+
+        gene_packed holds one row per gene of a dataset, with the
+        cell ids & values of its nonzero entries packed in two blobs
+        (see `packed.pack`); cell_packed holds the same per cell.
+        Reading a gene is then a single row fetch. Every gene & cell
+        gets a row, so a missing row means the dataset is not packed.
+        Re-importing a dataset drops its packed vectors. Without
+        `dataset_ids` all datasets are packed. Each dataset is read
+        from expr once per table, sorted, in batches of `chunksize`
+        nonzero entries.
+        """
+        import numpy as np
+
+        from .packed import packed_dtype
+
+        for table, key, index, _ in self.PACKED_TABLES:
+            self.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    dataset_id INTEGER,
+                    {key} INTEGER,
+                    nnz INTEGER,
+                    {index}s BLOB,
+                    vals BLOB)""")
+
+        if dataset_ids is None:
+            dataset_ids = list(self.sql(
+                "SELECT dataset_id FROM dataset_shape ORDER BY dataset_id"
+            )['dataset_id'])
+
+        for dataset_id in dataset_ids:
+            dtype = packed_dtype(self.value_dtype(dataset_id))
+            shape = self.sql("""
+                SELECT n_cells, n_genes FROM dataset_shape
+                 WHERE dataset_id = ?""", [dataset_id]).iloc[0]
+
+            with self.transaction():
+                self.drop_packed([dataset_id])
+                for table, key, index, n_col in self.PACKED_TABLES:
+                    lg.info(f"pack {table} of dataset {dataset_id}")
+                    store = partial(self._store_packed, table, key, index,
+                                    dataset_id, dtype)
+                    # entries of the last key in a batch may continue
+                    # in the next one, so they are carried over
+                    start = 0
+                    carry = [np.zeros(0, dtype=np.int32)] * 2 \
+                        + [np.zeros(0, dtype=np.float32)]
+                    for batch in self.stream(f"""
+                            SELECT {key}, {index}, value FROM expr
+                             WHERE dataset_id = ?
+                             ORDER BY {key}, {index}""",
+                            [dataset_id], batch_size=chunksize):
+                        if batch.num_rows == 0:
+                            continue
+                        cols = [np.concatenate([old, new.to_numpy()])
+                                for old, new in zip(carry, batch.columns)]
+                        stop = int(cols[0][-1])
+                        done = np.searchsorted(cols[0], stop)
+                        if stop > start:
+                            store(*(c[:done] for c in cols), start, stop)
+                            start = stop
+                        carry = [c[done:] for c in cols]
+                    n_keys = int(shape[n_col])
+                    if start < n_keys:
+                        store(*carry, start, n_keys)
+
+
+    def _store_packed(self,
+                      table: str,
+                      key: str,
+                      index: str,
+                      dataset_id: int,
+                      dtype: str,
+                      keys: "np.ndarray",
+                      idx: "np.ndarray",
+                      values: "np.ndarray",
+                      start: int,
+                      stop: int) -> None:
+        """Pack & append the vectors of keys `start` up to `stop`."""
+        import numpy as np
+        import pyarrow as pa
+
+        from .packed import iter_packed
+
+        packed = list(zip(*iter_packed(
+            keys, idx, values, start, stop, dtype)))
+        self.bulk_append(table, {
+            'dataset_id': dataset_id,
+            key: np.asarray(packed[0], dtype=np.int32),
+            'nnz': np.asarray(packed[1], dtype=np.int32),
+            f'{index}s': pa.array(packed[2], pa.binary()),
+            'vals': pa.array(packed[3], pa.binary())})
+
+
+    def import_parquet_shards(self,
+                              dataset_ids: Sequence[int],
+                              paths: Sequence[str],
+                              cluster: bool = False,
+                              ) -> None:
+        """Replace the expression data of datasets from Parquet shards.
+
+        All shards are loaded with a single insert; see
+        `ingest.write_shards`. With `cluster`, rows are inserted
+        ordered by dataset, gene & cell (see `cluster_expr`).
+        """
+        lg.info(f"load {len(paths)} shards for datasets "
+                f"{list(dataset_ids)}")
+
+        self.create_expr_table()
+        self.drop_packed(dataset_ids)
+        source = "read_parquet(?, union_by_name = true)"
+        paths = [str(path) for path in paths]
+        if self.storage_mode() == 'parquet':
+            for dataset_id in dataset_ids:
+                if len(paths) == 0:
+                    self._swap_partition(dataset_id, None)
+                    continue
+                order = "ORDER BY gene_id, cell_id" if cluster else ""
+                self.copy_partition(dataset_id, f"""
+                    SELECT cell_id, gene_id, value FROM {source}
+                     WHERE dataset_id = ? {order}""", [paths, dataset_id])
+        else:
+            self.execute("""
+                DELETE FROM expr
+                 WHERE dataset_id IN (SELECT unnest(?))""", [dataset_ids])
+
+            if len(paths) > 0:
+                order = ""
+                if cluster:
+                    order = "ORDER BY dataset_id, gene_id, cell_id"
+                self.execute(
+                    f"INSERT INTO expr BY NAME SELECT * FROM {source} {order}",
+                    [paths])
+
+        for dataset_id in dataset_ids:
+            self.bump_generation(f'dataset/{dataset_id}')
+
+
+    def bulk_append(self,
+                    table: str,
+                    columns: Dict[str, Any],
+                    ) -> None:
+        """Append column buffers to a table with a single insert.
+
+        `columns` maps column names to NumPy arrays, Arrow arrays or
+        scalars (which are broadcast). NumPy buffers are wrapped as
+        Arrow arrays without copying; string columns are best passed
+        as Arrow dictionary arrays (integer codes + labels). The table
+        is created if it does not exist.
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        length = next(len(c) for c in columns.values()
+                      if not np.isscalar(c))
+        arrays = {}
+        for name, col in columns.items():
+            if np.isscalar(col):
+                col = np.full(length, col)
+            arrays[name] = col
+
+        bulk_chunk = pa.table(arrays)
+
+        lg.debug(f"bulk append to {table}: {length:_d} rows")
+        if not self.table_exists(table):
+            # dictionary columns are stored as their values, not as
+            # an enum of this first chunk
+            select = ", ".join(
+                f'CAST("{field.name}" AS VARCHAR) AS "{field.name}"'
+                if pa.types.is_dictionary(field.type)
+                else f'"{field.name}"'
+                for field in bulk_chunk.schema)
+            self.conn.register('bulk_chunk', bulk_chunk)
+            self.execute(f"""
+                CREATE TABLE '{table}' AS
+                SELECT {select} FROM bulk_chunk LIMIT 0""")
+        else:
+            self.conn.register('bulk_chunk', bulk_chunk)
 
-        self.conn.sql(sql)
+        # same statement for every chunk
+        self.execute(
+            f"INSERT INTO '{table}' BY NAME SELECT * FROM bulk_chunk")
+        self.conn.unregister('bulk_chunk')
 
 
     def create_or_append(
@@ -350,13 +1413,14 @@ class CHDB:
         local_df = local_df.sort_index(axis=1)
 
         #create a table - or if it exists - append
+        # (run in this frame - duckdb finds local_df here)
         if not self.table_exists(table):
             #lg("create & insert", table, local_df.shape)
             sql = f"CREATE TABLE '{table}' AS SELECT * FROM local_df"
             lg.debug(sql)
-            self.sql(sql)
+            self.execute(sql)
         else:
             #lg("append tbl", table, local_df.shape)
             sql = f"INSERT INTO '{table}' SELECT * FROM local_df"
             lg.debug(sql)
-            self.sql(sql)
+            self.execute(sql)
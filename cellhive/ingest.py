@@ -0,0 +1,472 @@
+"""Stream expression matrices without densifying them."""
+
+import logging
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import h5py
+    import numpy as np
+    from anndata import AnnData
+
+
+lg = logging.getLogger(__name__)
+
+
+# number of nonzero entries emitted per chunk
+DEFAULT_CHUNKSIZE = 2_000_000
+
+# rough peak memory per nonzero entry while ingesting: the index &
+# value arrays, the dataframe built from them and duckdb's copy.
+BYTES_PER_ENTRY = 96
+
+# largest integer up to which all counts are exact in a FLOAT (float32)
+MAX_EXACT_COUNT = 2**24
+
+
+def value_dtype(layer_type: str, vmax: float) -> str:
+    """Choose the NumPy dtype to store the values of a layer in.
+
+    Counts become unsigned integers (uint16 when they fit), all other
+    layers float32. expr holds values as FLOAT, so counts above
+    `MAX_EXACT_COUNT` cannot be stored exactly: such layers are stored
+    (and recorded) as float32, with a warning.
+    """
+    if layer_type == 'count':
+        if vmax <= 65535:
+            return 'uint16'
+        if vmax <= MAX_EXACT_COUNT:
+            return 'uint32'
+        lg.warning(f"counts up to {vmax:.0f} do not fit FLOAT exactly, "
+                   "storing the layer as float32")
+    return 'float32'
+
+
+def compact_values(values: "np.ndarray",
+                   dtype: str,
+                   step: float = 0) -> "np.ndarray":
+    """Convert values to their storage dtype.
+
+    If `step` is set, (float) values are rounded to a multiple of
+    `step` first - a fixed-point representation with a maximum error
+    of step / 2.
+    """
+    import numpy as np
+
+    if step and dtype.startswith('float'):
+        values = np.round(values / step) * step
+
+    if dtype.startswith('uint'):
+        rounded = np.round(values)
+        if (rounded != values).any() or (values < 0).any():
+            raise ValueError(
+                "count layer holds negative or non-integer values")
+        values = rounded
+
+    return np.asarray(values, dtype=dtype)
+
+
+def chunksize_for(max_memory: int) -> int:
+    """Number of nonzero entries per chunk that fit a memory budget."""
+    return max(1, max_memory // BYTES_PER_ENTRY)
+
+
+class H5Sparse:
+    """Read-only view on a CSR/CSC matrix stored in an HDF5 group.
+
+    Only `indptr` is loaded; `indices` and `data` stay on disk and are
+    sliced chunk by chunk.
+    """
+
+    def __init__(self, group: "h5py.Group") -> None:
+        attrs = group.attrs
+        if 'encoding-type' in attrs:
+            self.format = str(attrs['encoding-type']).split('_')[0]
+            self.shape = tuple(int(x) for x in attrs['shape'])
+        else:
+            # files written by old anndata versions
+            self.format = str(attrs['h5sparse_format'])
+            self.shape = tuple(int(x) for x in attrs['h5sparse_shape'])
+
+        self.group = group
+        self.indptr = group['indptr'][:]
+        self.indices = group['indices']
+        self.data = group['data']
+        self.dtype = self.data.dtype
+
+
+def _read_elem(elem: Any) -> Any:
+    """Read one element of an h5ad file with anndata."""
+    try:
+        from anndata.io import read_elem
+    except ImportError:
+        # older anndata versions
+        from anndata.experimental import read_elem
+    return read_elem(elem)
+
+
+def open_h5ad(path: str) -> Tuple["AnnData", "h5py.File"]:
+    """Open an h5ad file without loading any expression matrix.
+
+    Returns an AnnData holding only obs, var, obsm & uns, plus the
+    open HDF5 file to stream X, layers & raw/X from.
+    """
+    import anndata as ad
+    import h5py
+
+    h5file = h5py.File(path, 'r')
+    elems = {k: _read_elem(h5file[k])
+             for k in ['obs', 'var', 'obsm', 'uns']
+             if k in h5file}
+    adata = ad.AnnData(obs=elems['obs'], var=elems['var'],
+                       obsm=elems.get('obsm'), uns=elems.get('uns'))
+    return adata, h5file
+
+
+def h5_layers(h5file: "h5py.File") -> List[str]:
+    """Names of the matrices in an h5ad file ('X', layers, 'RAW')."""
+    rv = []
+    if 'X' in h5file:
+        rv.append('X')
+    rv.extend(h5file.get('layers', {}).keys())
+    if 'raw' in h5file and 'X' in h5file['raw']:
+        rv.append('RAW')
+    return rv
+
+
+def h5_matrix(h5file: "h5py.File", layer: str) -> Any:
+    """Return an on-disk matrix from an h5ad file."""
+    import h5py
+
+    key = {'X': 'X', 'RAW': 'raw/X'}.get(layer, f'layers/{layer}')
+    elem = h5file[key]
+    if isinstance(elem, h5py.Group):
+        return H5Sparse(elem)
+    # dense dataset - iter_nonzero reads this in row blocks
+    return elem
+
+
+def get_names(adata: "AnnData",
+              layer: str,
+              h5file: Optional["h5py.File"] = None,
+              ) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Return the obs & var names of a layer ('RAW' has its own var)."""
+    import numpy as np
+
+    if layer != 'RAW':
+        var_names = adata.var_names
+    elif h5file is not None:
+        var_names = _read_elem(h5file['raw/var']).index
+    else:
+        var_names = adata.raw.var_names
+
+    return (np.asarray(adata.obs_names, dtype=object),
+            np.asarray(var_names, dtype=object))
+
+
+def get_matrix(adata: "AnnData",
+               layer: str,
+               h5file: Optional["h5py.File"] = None,
+               ) -> Tuple[Any, "np.ndarray", "np.ndarray"]:
+    """Return the matrix for a layer, with obs & var names.
+
+    `layer` is a layer name, 'X' or 'RAW'. If `h5file` is given, the
+    matrix is read from disk (see `open_h5ad`).
+    """
+    if h5file is not None:
+        matrix = h5_matrix(h5file, layer)
+    elif layer == 'X':
+        matrix = adata.X
+    elif layer == 'RAW':
+        matrix = adata.raw.X
+    else:
+        matrix = adata.layers[layer]
+
+    return (matrix, *get_names(adata, layer, h5file))
+
+
+def _iter_compressed(indptr: "np.ndarray",
+                     indices: "np.ndarray",
+                     data: "np.ndarray",
+                     chunksize: int,
+                     start: int = 0,
+                     stop: Optional[int] = None,
+                     ) -> Iterator[Tuple["np.ndarray", "np.ndarray", "np.ndarray"]]:
+    """Walk compressed (CSR/CSC) buffers along the major axis.
+
+    Yields (major, minor, value) arrays, each chunk holding at most
+    `chunksize` entries - unless a single major row/column is larger.
+    Only major rows/columns `start` up to `stop` are walked.
+    """
+    import numpy as np
+
+    n_major = len(indptr) - 1 if stop is None else stop
+    while start < n_major:
+        target = indptr[start] + chunksize
+        stop = int(np.searchsorted(indptr, target, side='right')) - 1
+        stop = min(max(stop, start + 1), n_major)
+
+        lo, hi = int(indptr[start]), int(indptr[stop])
+        counts = np.diff(indptr[start:stop + 1])
+        major = np.repeat(np.arange(start, stop, dtype=np.int64), counts)
+        minor = np.asarray(indices[lo:hi], dtype=np.int64)
+        values = np.asarray(data[lo:hi])
+
+        # explicit zeros may be stored in sparse matrices
+        keep = values != 0
+        if not keep.all():
+            major, minor, values = major[keep], minor[keep], values[keep]
+
+        yield major, minor, values
+        start = stop
+
+
+def _is_compressed(matrix: Any) -> bool:
+    """Is this a CSR/CSC matrix we can walk buffer by buffer?"""
+    import scipy.sparse
+    return isinstance(matrix, H5Sparse) or (
+        scipy.sparse.issparse(matrix) and matrix.format in ('csr', 'csc'))
+
+
+def major_size(matrix: Any) -> int:
+    """Length of the axis `iter_nonzero` walks (columns for CSC)."""
+    if _is_compressed(matrix):
+        return len(matrix.indptr) - 1
+    return matrix.shape[0]
+
+
+def iter_nonzero(matrix: Any,
+                 chunksize: int = DEFAULT_CHUNKSIZE,
+                 start: int = 0,
+                 stop: Optional[int] = None,
+                 ) -> Iterator[Tuple["np.ndarray", "np.ndarray", "np.ndarray"]]:
+    """Yield (row, col, value) arrays with the nonzero entries of a matrix.
+
+    CSR and CSC matrices (in memory or `H5Sparse` on disk) are walked
+    through their indptr/indices/data buffers; dense and backed
+    matrices are read in row blocks. Memory use scales with
+    `chunksize` (nonzero entries per chunk), not with the size of the
+    matrix.
+
+    `start` & `stop` limit the walk to a range of the major axis
+    (columns for CSC, rows otherwise - see `major_size`).
+    """
+    import numpy as np
+    import scipy.sparse
+
+    if scipy.sparse.issparse(matrix) and not _is_compressed(matrix):
+        matrix = matrix.tocsr()
+
+    if _is_compressed(matrix):
+        walk = _iter_compressed(
+            matrix.indptr, matrix.indices, matrix.data, chunksize,
+            start=start, stop=stop)
+        if matrix.format == 'csr':
+            yield from walk
+        else:
+            for cols, rows, values in walk:
+                yield rows, cols, values
+        return
+
+    n_rows, n_cols = matrix.shape
+    if stop is not None:
+        n_rows = stop
+    # rows per block - so a full block fits in a chunk
+    block = max(1, chunksize // max(1, n_cols))
+
+    if isinstance(matrix, np.ndarray):
+        for r0 in range(start, n_rows, block):
+            chunk = np.asarray(matrix[r0:min(r0 + block, n_rows)])
+            rows, cols = np.nonzero(chunk)
+            yield rows + r0, cols, chunk[rows, cols]
+        return
+
+    # anything else (backed datasets, np.matrix, ...) - slice row
+    # blocks and walk each of these
+    for r0 in range(start, n_rows, block):
+        chunk = matrix[r0:min(r0 + block, n_rows)]
+        if not scipy.sparse.issparse(chunk):
+            chunk = np.asarray(chunk)
+        for rows, cols, values in iter_nonzero(chunk, chunksize):
+            yield rows + r0, cols, values
+
+
+def _hash_update(hasher: Any, part: Any) -> None:
+    """Feed one array, series or string to a hashlib hasher."""
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(part, (pd.Series, pd.Index)):
+        hasher.update(str(part.dtype).encode())
+        part = pd.util.hash_pandas_object(
+            part, index=isinstance(part, pd.Series)).to_numpy()
+    elif isinstance(part, np.ndarray) and part.dtype == object:
+        part = pd.util.hash_array(part)
+
+    if isinstance(part, np.ndarray):
+        hasher.update(str((part.dtype, part.shape)).encode())
+        hasher.update(np.ascontiguousarray(part).data)
+    else:
+        hasher.update(str(part).encode())
+
+
+def fingerprint(*parts: Any) -> str:
+    """Content hash of arrays, series & strings, as a hex string."""
+    import hashlib
+
+    hasher = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        _hash_update(hasher, part)
+    return hasher.hexdigest()
+
+
+def matrix_stats(matrix: Any,
+                 chunksize: int = DEFAULT_CHUNKSIZE,
+                 fingerprint: bool = False) -> Dict[str, Any]:
+    """Min, max & number of nonzero entries, streaming over the matrix.
+
+    With `fingerprint`, a content hash of the nonzero entries is
+    computed in the same pass.
+    """
+    import hashlib
+
+    import numpy as np
+
+    n_rows, n_cols = matrix.shape
+    nnz = 0
+    vmin, vmax = np.inf, -np.inf
+    hasher = hashlib.blake2b(digest_size=16)
+    _hash_update(hasher, str(matrix.shape))
+    for rows, cols, values in iter_nonzero(matrix, chunksize):
+        if len(values) == 0:
+            continue
+        if fingerprint:
+            for part in (rows, cols, values):
+                _hash_update(hasher, part)
+        nnz += len(values)
+        vmin = min(vmin, values.min())
+        vmax = max(vmax, values.max())
+
+    entries = n_rows * n_cols
+    if nnz < entries:
+        # there are zeros
+        vmin = min(vmin, 0)
+        vmax = max(vmax, 0)
+
+    rv = dict(min=vmin, max=vmax, nnz=nnz, entries=entries)
+    if fingerprint:
+        rv['fingerprint'] = hasher.hexdigest()
+    return rv
+
+
+def shard_ranges(matrix: Any,
+                 chunksize: int) -> List[Tuple[int, int]]:
+    """Split the major axis in ranges of about `chunksize` nonzeros."""
+    n_major = major_size(matrix)
+    if not _is_compressed(matrix):
+        # dense - fixed number of rows per range
+        block = max(1, chunksize // max(1, matrix.shape[1]))
+        return [(r0, min(r0 + block, n_major))
+                for r0 in range(0, n_major, block)]
+
+    return indptr_ranges(matrix.indptr, chunksize)
+
+
+def indptr_ranges(indptr: "np.ndarray",
+                  chunksize: int) -> List[Tuple[int, int]]:
+    """Split the rows of an indptr array in ranges of `chunksize` nonzeros.
+
+    A row with more than `chunksize` entries gets a range of its own.
+    """
+    import numpy as np
+
+    n_major = len(indptr) - 1
+    rv = []
+    start = 0
+    while start < n_major:
+        stop = int(np.searchsorted(
+            indptr, indptr[start] + chunksize, side='right')) - 1
+        stop = min(max(stop, start + 1), n_major)
+        rv.append((start, stop))
+        start = stop
+    return rv
+
+
+def write_shard(h5ad: str,
+                layer: str,
+                dataset_id: int,
+                start: int,
+                stop: int,
+                path: str,
+                chunksize: int,
+                dtype: str = 'float32',
+                step: float = 0) -> int:
+    """Write the nonzero entries of part of a layer to a Parquet file.
+
+    Runs in a worker process: reads the matrix from the h5ad file,
+    sorts the entries by gene & cell and writes one row group per
+    chunk, keyed by gene & cell ids (see `CHDB.store_dims`). Returns
+    the number of entries written.
+    """
+    import h5py
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    written = 0
+    with h5py.File(h5ad, 'r') as h5file:
+        matrix = h5_matrix(h5file, layer)
+        writer = None
+        for rows, cols, values in iter_nonzero(
+                matrix, chunksize, start=start, stop=stop):
+            order = np.lexsort((rows, cols))
+            shard = pa.table({
+                'dataset_id': np.full(len(order), dataset_id),
+                'gene_id': cols[order].astype(np.int32),
+                'cell_id': rows[order].astype(np.int32),
+                'value': compact_values(values[order], dtype, step)})
+            if writer is None:
+                writer = pq.ParquetWriter(path, shard.schema)
+            writer.write_table(shard)
+            written += len(order)
+        if writer is not None:
+            writer.close()
+    return written
+
+
+def write_shards(h5ad: str,
+                 layers: Dict[str, Tuple[int, str, float]],
+                 outdir: str,
+                 jobs: int,
+                 chunksize: int = DEFAULT_CHUNKSIZE,
+                 ) -> List[str]:
+    """Convert layers of an h5ad file to Parquet shards in parallel.
+
+    `layers` maps layer names to (dataset id, value dtype, quantization
+    step). Each layer is split in ranges of about `chunksize` nonzero
+    entries, and `jobs` worker processes write one shard per range
+    into `outdir`. Returns the paths of the shards written.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from pathlib import Path
+
+    import h5py
+
+    tasks = []
+    with h5py.File(h5ad, 'r') as h5file:
+        for layer, (dataset_id, dtype, step) in layers.items():
+            matrix = h5_matrix(h5file, layer)
+            for i, (start, stop) in enumerate(
+                    shard_ranges(matrix, chunksize)):
+                path = str(Path(outdir) / f"{dataset_id}_{i:06d}.parquet")
+                tasks.append((h5ad, layer, dataset_id, start, stop,
+                              path, chunksize, dtype, step))
+
+    lg.info(f"writing {len(tasks)} shards with {jobs} processes")
+    paths = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(write_shard, *task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            if future.result() > 0:
+                # empty ranges write no file
+                paths.append(task[5])
+    return paths
@@ -5,6 +5,7 @@ from typing import Any, Dict, List, Optional, Union, \
 
 
 if TYPE_CHECKING:
+    import h5py
     import scanpy as sc
     import pandas as pd
 
@@ -133,13 +134,19 @@ def md(adata, **kwargs):
     return adata.uns['cellhive']['metadata']
 
 
-def get_layerdata(adata: "sc.AnnData"):
-    """Create stats on the layers in this adata."""
-    from anndata._core.sparse_dataset import SparseDataset
-    import scanpy as sc
-    import scipy
+def get_layerdata(adata: "sc.AnnData",
+                  h5file: Optional["h5py.File"] = None,
+                  fingerprint: bool = False):
+    """Create stats on the layers in this adata.
+
+    If `h5file` is given (see `ingest.open_h5ad`), the layers are
+    streamed from disk instead of from `adata`. With `fingerprint`,
+    a content hash of each layer is added.
+    """
     import pandas as pd
 
+    from .ingest import h5_layers, h5_matrix, matrix_stats
+
     ldata = adata.uns['cellhive']['layers']
 
     def check_layer(name: str, layer_data):
@@ -147,21 +154,19 @@ def get_layerdata(adata: "sc.AnnData"):
         if name not in ldata:
             ldata[name] = {}
 
-        if isinstance(layer_data, SparseDataset):
-            layer_data = layer_data.value.todense()
-        elif isinstance(layer_data, scipy.sparse._csr.csr_matrix):
-            layer_data = layer_data.todense()
+        # stream over the (sparse) matrix - never densify
+        stats = matrix_stats(layer_data, fingerprint=fingerprint)
 
         row: Dict[str, Any] = {}
         row['name'] = name
         row['dtype'] = layer_data.dtype
         row['rows'] = layer_data.shape[0]
         row['columns'] = layer_data.shape[1]
-        row['entries'] = entries = layer_data.shape[0] * layer_data.shape[1]
-        row['min'] = layer_data.min()
-        row['max'] = layer_data.max()
+        row['entries'] = entries = stats['entries']
+        row['min'] = stats['min']
+        row['max'] = stats['max']
 
-        zeros = len((layer_data==0).nonzero()[0])
+        zeros = entries - stats['nnz']
         perc_zeros = 100 * zeros / entries
 
         row['no_zeros'] = zeros
@@ -187,17 +192,22 @@ def get_layerdata(adata: "sc.AnnData"):
                 lg.warning(f"Setting layer {name} to type: logrpm!")
                 chtype = ldata[name]['type'] = 'logrpm'
         row['layer_type'] = chtype
+        if fingerprint:
+            row['fingerprint'] = stats['fingerprint']
         return row
 
     layerdata = []
+    if h5file is not None:
+        for layer in h5_layers(h5file):
+            layerdata.append(check_layer(layer, h5_matrix(h5file, layer)))
+        return pd.DataFrame(layerdata)
+
     layerdata.append(check_layer('X', adata.X))
     for layer in adata.layers.keys():
         layerdata.append(check_layer(layer, adata.layers[layer]))
 
     if adata.raw is not None:
-#        ar = adata.raw.to_adata()
-        ar = adata.raw.to_adata()
-        layerdata.append(check_layer('RAW', ar.X))
+        layerdata.append(check_layer('RAW', adata.raw.X))
 
     return pd.DataFrame(layerdata)
 
@@ -206,7 +216,9 @@ def layers(adata,
            name: Union[str, None] = None,
            ltype: Union[str, None] = None,
            ignore: Union[bool, None] = None,
-           description: Union[str, None] = None) \
+           description: Union[str, None] = None,
+           h5file: Optional["h5py.File"] = None,
+           fingerprint: bool = False) \
         -> Optional["pd.DataFrame"]:
     """Get or set layer data.
 
@@ -214,6 +226,8 @@ def layers(adata,
     Usage:
        layers(): returns a dataframe
        layers(name='layername', [type='layertype', [load=True/False]]):
+       layers(h5file=h5file): stream layer stats from an open h5ad file
+       layers(fingerprint=True): add a content hash of each layer
     """
     if name is not None:
         ldata = adata.uns['cellhive']['layers']
@@ -230,14 +244,15 @@ def layers(adata,
         if description is not None:
             ldata[name]['description'] = description
 
-    df = get_layerdata(adata)
+    df = get_layerdata(adata, h5file=h5file, fingerprint=fingerprint)
     return df.T
 
 
 def obsm(adata: "sc.AnnData",
          name: Union[str,  None] = None,
          ignore: Union[bool,  None] = None,
-         description: Union[str,  None] = None) -> Union["pd.DataFrame", None]:
+         description: Union[str,  None] = None,
+         dims: Union[int,  None] = None) -> Union["pd.DataFrame", None]:
     """
     Retrieve and process dimensionality reduction matrici data from `adata`.
 
@@ -247,6 +262,9 @@ def obsm(adata: "sc.AnnData",
             retrieve. Defaults to None.
         ignore (Union[bool,  None], optional): Boolean value indicating whether
             to ignore the `obsm` data. Defaults to None.
+        dims (Union[int,  None], optional): Number of dimensions to
+            store in the database (e.g. top-k of a PCA). Defaults to
+            None (all).
 
     Returns:
         pd.DataFrame: Transposed DataFrame containing the retrieved
@@ -268,6 +286,8 @@ def obsm(adata: "sc.AnnData",
             ao[name]['ignore'] = ignore
         if description is not None:
             ao[name]['description'] = description
+        if dims is not None:
+            ao[name]['dims'] = dims
 
     rv = []
 
@@ -283,6 +303,7 @@ def obsm(adata: "sc.AnnData",
             name=o,
             dim=adata.obsm[o].shape[1],
             ignore=ao.get(o, {}).get('ignore', '-'),
+            dims=ao.get(o, {}).get('dims', '-'),
             description=ao.get(o, {}).get('description', '-'),
         ))
 
@@ -299,6 +320,11 @@ def obs_conv_float(adata: "scanpy.AnnData", column: str) -> None:  # noqa: F821
     adata.obs[column] = adata.obs[column].astype(float)
 
 
+def obs_conv_bool(adata: "scanpy.AnnData", column: str) -> None:  # noqa: F821
+    """Convert column to (nullable) booleans."""
+    adata.obs[column] = adata.obs[column].astype('boolean')
+
+
 def obs_conv_categorical(adata: "scanpy.AnnData", column: str) \
         -> None:  # noqa: F821
     """Convert column to categorical."""
@@ -308,6 +334,7 @@ def obs_conv_categorical(adata: "scanpy.AnnData", column: str) \
 OBS_CONV_FUNCTIONS = {
     'int': obs_conv_int,
     'float': obs_conv_float,
+    'bool': obs_conv_bool,
     'cat': obs_conv_categorical
     }
 
@@ -359,7 +386,10 @@ def get_obs_column_metadata(adata: "sc.AnnData",
             set_obs_col_md(adata, column, 'dtype', 'cat')
             lg.warning("Expect {column} to be cluster IDs, forcing to categorical")
 
-    if odtype in ['categorical', 'category', 'cat', 'object', 'bool', 'str']:
+    if odtype in ['bool', 'boolean']:
+        # stored as booleans, not as a category
+        dtype = 'bool'
+    elif odtype in ['categorical', 'category', 'cat', 'object', 'str']:
         # guess categorical
         uniq = len(obs_col.unique())
         example = ", ".join(map(str, obs_col.value_counts().sort_values()[:no_example].index))
@@ -438,8 +468,8 @@ def obs(adata: "sc.AnnData",
             if dtype in ['str', 'categorical']:
                 dtype = 'cat'
 
-            if dtype not in ['int', 'float', 'cat']:
-                lg.error("dtype must be one of: int, float or cat")
+            if dtype not in ['int', 'float', 'bool', 'cat']:
+                lg.error("dtype must be one of: int, float, bool or cat")
                 return None
             else:
                 lg.info(f"Convert obs column {column} to {dtype}")
@@ -461,6 +491,8 @@ def obs(adata: "sc.AnnData",
             obs_data = obs_data[obs_data['dtype'] == 'cat']
         elif select == 'int':
             obs_data = obs_data[obs_data['dtype'] == 'int']
+        elif select == 'bool':
+            obs_data = obs_data[obs_data['dtype'] == 'bool']
         elif select == 'float':
             obs_data = obs_data[obs_data['dtype'] == 'float']
         elif select in ['num', 'numerical']:
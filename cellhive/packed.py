@@ -0,0 +1,67 @@
+"""Packed sparse vectors: the nonzero entries of one gene or cell."""
+
+from typing import TYPE_CHECKING, Iterator, Tuple
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+def packed_dtype(dtype: str) -> str:
+    """Dtype values are packed in - as stored in expr (FLOAT) at most."""
+    return 'float32' if dtype == 'float64' else dtype
+
+
+def pack(index: "np.ndarray",
+         values: "np.ndarray",
+         dtype: str) -> Tuple[bytes, bytes]:
+    """Pack sorted indices & their values into two compressed blobs.
+
+    Indices are delta-encoded (uint32) before compression, so the
+    runs of small gaps between neighbouring cells (or genes) pack
+    well. Values are kept in `dtype`.
+    """
+    import zlib
+
+    import numpy as np
+
+    deltas = np.diff(np.asarray(index, dtype=np.int64), prepend=0)
+    return (zlib.compress(deltas.astype('<u4').tobytes(), 1),
+            zlib.compress(np.asarray(
+                values, dtype=np.dtype(dtype).newbyteorder('<')
+            ).tobytes(), 1))
+
+
+def unpack(index_blob: bytes,
+           value_blob: bytes,
+           dtype: str) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Decode blobs written by `pack` to (index, values) arrays."""
+    import zlib
+
+    import numpy as np
+
+    deltas = np.frombuffer(zlib.decompress(index_blob), dtype='<u4')
+    index = np.cumsum(deltas, dtype=np.int32)
+    values = np.frombuffer(zlib.decompress(value_blob),
+                           dtype=np.dtype(dtype).newbyteorder('<'))
+    return index, values
+
+
+def iter_packed(keys: "np.ndarray",
+                index: "np.ndarray",
+                values: "np.ndarray",
+                start: int,
+                stop: int,
+                dtype: str) -> Iterator[Tuple[int, int, bytes, bytes]]:
+    """Pack the entries of keys `start` up to `stop`.
+
+    `keys`, `index` & `values` hold the nonzero entries, sorted by key
+    and index. Yields (key, nnz, index blob, value blob) for every key
+    in the range - keys without entries get empty vectors.
+    """
+    import numpy as np
+
+    bounds = np.searchsorted(keys, np.arange(start, stop + 1))
+    for key in range(start, stop):
+        lo, hi = bounds[key - start], bounds[key - start + 1]
+        yield (key, int(hi - lo),
+               *pack(index[lo:hi], values[lo:hi], dtype))
@@ -27,6 +27,16 @@ def mdget(key:str,
                default=default)
 
 
+def parse_size(size: str) -> int:
+    """Parse a human readable size (e.g. '512MB', '4G') to bytes."""
+    import re
+    units = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?)(I?B)?\s*", size.upper())
+    if not match:
+        raise ValueError(f"Cannot parse size: {size}")
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
 def simple_disk_cache(cache_path: Path,
                       cache_name: str,
                       force: bool = False,
@@ -0,0 +1,111 @@
+"""Fixtures: small cellhive databases."""
+
+from typing import Sequence
+
+import numpy as np
+import pytest
+
+from cellhive.db import CHDB
+
+
+def add_dataset(chdb: CHDB,
+                experiment: str,
+                var_names: Sequence[str],
+                n_cells: int = 50) -> int:
+    """Store a random count layer, one obs column & an embedding.
+
+    Ids are allocated as `ch upload` does. Returns the dataset id.
+    """
+    import anndata as ad
+    import pandas as pd
+    import scipy.sparse
+
+    X = scipy.sparse.random(n_cells, len(var_names), density=0.3,
+                            format='csr', random_state=0)
+    X.data = np.ceil(X.data * 10)
+    adata = ad.AnnData(
+        X=X, obs=pd.DataFrame(index=[f"cell{i}" for i in range(n_cells)]),
+        var=pd.DataFrame(index=list(var_names)))
+
+    full_experiment = f"study__{experiment}__0"
+    exp_id = chdb.get_id('experiment_md', 'full_experiment',
+                         full_experiment)
+    dataset = f"{full_experiment}__X"
+    dataset_id = chdb.get_id('experiment_md', 'dataset', dataset)
+    chdb.uac_experiment_md(dict(
+        study='study', experiment=experiment, version='0',
+        full_experiment=full_experiment, full_experiment_id=exp_id,
+        dataset=dataset, dataset_id=dataset_id, layer_name='X',
+        layer_type='count', title=experiment))
+    chdb.import_count_table(dataset_id, adata, 'X', dtype='uint16')
+    chdb.store_obs(
+        exp_id, adata.obs_names,
+        {'group': (np.arange(n_cells) % 3, 'cat')},
+        obsm={'X_umap': np.arange(n_cells * 2).reshape(n_cells, 2)})
+    return dataset_id
+
+
+@pytest.fixture
+def make_db(tmp_path):
+    """Build a database with one experiment with these gene names.
+
+    Returns (database file, dataset id).
+    """
+    def make(var_names: Sequence[str]):
+        path = str(tmp_path / 'cellhive.duckdb')
+        chdb = CHDB(path)
+        dataset_id = add_dataset(chdb, 'one', var_names)
+        chdb.conn.close()
+        return path, dataset_id
+    return make
+
+
+@pytest.fixture
+def dbfile(make_db):
+    """A database with one experiment of 50 cells x 10 genes."""
+    return make_db([f"gene{i}" for i in range(10)])[0]
+
+
+@pytest.fixture
+def make_h5ad(tmp_path):
+    """Write an h5ad file with cellhive metadata that `ch upload` accepts.
+
+    Holds a count X, a logrpm layer and raw. Returns the file path.
+    """
+    def make(experiment: str = 'one',
+             n_cells: int = 60,
+             n_genes: int = 12,
+             fmt: str = 'csr',
+             seed: int = 0) -> str:
+        import anndata as ad
+        import pandas as pd
+        import scipy.sparse
+
+        rng = np.random.default_rng(seed)
+        X = scipy.sparse.random(n_cells, n_genes, density=0.2,
+                                format='csr', random_state=seed)
+        X.data = np.ceil(X.data * 100)
+        logrpm = X.astype(np.float32)
+        logrpm.data = np.log1p(logrpm.data / 10)
+
+        obs = pd.DataFrame(
+            dict(cell_type=pd.Categorical(rng.choice(['A', 'B'], n_cells))),
+            index=[f"cell{i}" for i in range(n_cells)])
+        adata = ad.AnnData(
+            X=X.asformat(fmt), obs=obs,
+            var=pd.DataFrame(index=[f"gene{i}" for i in range(n_genes)]))
+        adata.layers['logrpm'] = logrpm.asformat(fmt)
+        adata.raw = adata.copy()
+        adata.obsm['X_umap'] = rng.normal(size=(n_cells, 2))
+        adata.uns['cellhive'] = dict(
+            metadata=dict(author='author', title=experiment,
+                          organism='human', study='study',
+                          experiment=experiment, version='1'),
+            layers=dict(X=dict(type='count'), logrpm=dict(type='logrpm'),
+                        RAW=dict(type='count')),
+            obs={}, obsm={})
+
+        path = str(tmp_path / f"{experiment}.h5ad")
+        adata.write_h5ad(path)
+        return path
+    return make
@@ -0,0 +1,102 @@
+import pytest
+
+from cellhive.api import API
+
+
+def test_genes_rejects_duplicate_names(make_db):
+    path, dataset_id = make_db(['a', 'b', 'a', 'c'])
+    api = API(path)
+    with pytest.raises(ValueError, match='not unique'):
+        api.genes(dataset_id, ['b', 'a'])
+    with pytest.raises(ValueError, match='not unique'):
+        api.gene(dataset_id, 'a')
+    with pytest.raises(KeyError):
+        api.genes(dataset_id, ['b', 'x'])
+
+    # unique names are still fine
+    matrix = api.genes(dataset_id, ['c', 'b'], format='dense')
+    assert matrix.shape == (50, 2)
+    assert (matrix[:, 0] == api.gene(dataset_id, 'c')).all()
+
+
+def test_ids_from_query_results(dbfile):
+    # ids read from the database are NumPy scalars
+    api = API(dbfile)
+    md = api.datasets()
+    exp_id = md.full_experiment_id[0]
+    dataset_id = md.dataset_id[0]
+
+    assert api.obsm(exp_id, 'X_umap').shape == (50, 2)
+    assert len(api.obs_cat(exp_id, 'group')) == 50
+    assert api.gene(dataset_id, 'gene1').shape == (50,)
+    assert api.genes(dataset_id, ['gene1', 'gene2']).shape == (50, 2)
+    assert api.dataset(dataset_id).X.shape == (50, 10)
+    assert api.sql("SELECT COUNT(*) AS n FROM cell_dim WHERE dataset_id = ?",
+                   [dataset_id]).n[0] == 50
+
+
+def test_obs_native_types(dbfile):
+    import numpy as np
+    import pandas as pd
+
+    from cellhive.db import CHDB
+
+    chdb = CHDB(dbfile)
+    exp_id, obs_names = chdb.execute("""
+        SELECT exp_id, list(obs ORDER BY cell_id)
+          FROM obs_dim GROUP BY exp_id""").fetchone()
+    n = len(obs_names)
+    flags = pd.array(np.arange(n) % 2 == 0, dtype='boolean')
+    flags[0] = pd.NA
+    chdb.store_obs(exp_id, obs_names, {
+        'small': (np.arange(n, dtype=np.int8), 'int'),
+        'medium': (pd.array(np.arange(n), dtype='Int16'), 'int'),
+        'flag': (flags, 'bool')})
+    chdb.conn.close()
+
+    obs = API(dbfile).obs_num(exp_id, ['small', 'medium', 'flag'])
+    assert obs['small'].dtype == 'Int8'
+    assert obs['medium'].dtype == 'Int16'
+    assert obs['flag'].dtype == 'boolean'
+    assert (obs['small'].to_numpy() == np.arange(n)).all()
+    assert obs['flag'].isna().sum() == 1
+    assert obs['flag'].sum() == (n + 1) // 2 - 1
+
+
+def test_dataset_select_by_name(dbfile):
+    api = API(dbfile)
+    dataset_id = api.datasets().dataset_id[0]
+    ds = api.dataset(dataset_id)
+
+    assert len(ds.gene_ids) == 10
+    view = ds[['cell3', 'cell1'], ['gene2', 'gene0']]
+    # names are resolved without fetching the obs columns
+    assert 'obs' not in ds._cache
+    assert list(view.obs_names) == ['cell3', 'cell1']
+    assert list(view.var_names) == ['gene2', 'gene0']
+    assert (view.X.toarray() == ds.X.toarray()[[3, 1]][:, [2, 0]]).all()
+    assert list(view[['cell1']].obs_names) == ['cell1']
+    with pytest.raises(KeyError):
+        ds[['cell999']]
+
+    assert list(view.obs.index) == ['cell3', 'cell1']
+    assert 'group' in view.obs
+
+
+def test_cached_results_are_copies(dbfile):
+    api = API(dbfile)
+    exp_id = api.datasets().full_experiment_id[0]
+
+    obs = api.obs_cat(exp_id, 'group')
+    obs['group'] = 'changed'
+    obs['extra'] = 1
+    assert list(api.obs_cat(exp_id, 'group').columns) == ['group']
+    assert (api.obs_cat(exp_id, 'group')['group'] != 'changed').all()
+
+    coords = api.obsm(exp_id, 'X_umap')
+    coords[:] = -1
+    assert (api.obsm(exp_id, 'X_umap') >= 0).all()
+
+    md = api.datasets()
+    md.drop(columns=md.columns, inplace=True)
+    assert len(api.datasets().columns) > 0
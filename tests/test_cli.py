@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cellhive.api import API
+from cellhive.db import CHDB
+
+GENES = [f"gene{i}" for i in range(10)]
+
+
+def run(dbfile: str, *args: str, exit_code: int = 0) -> str:
+    """Run a `ch` command on a database, return its output."""
+    import gc
+
+    from click.testing import CliRunner
+
+    from cellhive.cli import cli
+
+    result = CliRunner().invoke(cli, ['--db', dbfile, *args])
+    output, code = result.output, result.exit_code
+    # close the connection of the command
+    del result
+    gc.collect()
+    assert code == exit_code, output
+    return output
+
+
+@pytest.fixture
+def groupdb(make_db):
+    """Two datasets: one with a 'group' column only, one that also has
+    a 'cell_type' column with missing values.
+
+    Returns (database file, {dataset id: cell_type or None}).
+    """
+    from conftest import add_dataset
+
+    path, first = make_db(GENES)
+    chdb = CHDB(path)
+    second = add_dataset(chdb, 'two', GENES)
+    exp_id = chdb.execute("""
+        SELECT full_experiment_id FROM experiment_md
+         WHERE dataset_id = ?""", [second]).fetchone()[0]
+    cell_type = pd.Categorical(
+        np.where(np.arange(50) % 4 == 0, 'T', 'B')).add_categories('NK')
+    cell_type[::7] = np.nan
+    chdb.store_obs(exp_id, [f"cell{i}" for i in range(50)],
+                   {'cell_type': (cell_type, 'cat')})
+    chdb.conn.close()
+    return path, {first: None, second: cell_type}
+
+
+def group_means(api: API, dataset_id: int, gene: str, groups) -> dict:
+    """Mean expression of a gene per group of cells."""
+    values = api.gene(dataset_id, gene)
+    labels = pd.Series(groups).astype(object).fillna('NA').to_numpy()
+    return {g: values[labels == g].mean() for g in set(labels)}
+
+
+def gene_index(dbfile: str, gene: str) -> dict:
+    """{(dataset id, cell group): (n_cells, mean)} of a gene."""
+    chdb = CHDB(dbfile)
+    entries = chdb.execute("""
+        SELECT unnest(entries, recursive := true)
+          FROM gene_index WHERE gene_key = ?""",
+        [gene.upper()]).fetchdf()
+    chdb.conn.close()
+    return {(r.dataset_id, r.cell_group): (r.n_cells, r.meanval)
+            for r in entries.itertuples()}
+
+
+def test_gene_index(groupdb):
+    dbfile, datasets = groupdb
+    first, second = datasets
+    run(dbfile, 'db', 'meta-tables', '-g', 'cell_type', '-g', 'group')
+
+    api = API(dbfile, read_only=False)
+    group = np.arange(50) % 3
+    got = gene_index(dbfile, 'Gene4')
+
+    # 'cell_type' is preferred over 'group'; its missing values are 'NA'
+    expected = group_means(api, second, 'gene4', datasets[second])
+    assert {g for d, g in got if d == second} == set(expected)
+    assert (second, 'NK') not in got
+    for g, mean in expected.items():
+        assert got[second, g][1] == pytest.approx(mean)
+    assert got[second, 'NA'][0] == 8
+
+    # no cell_type column - grouped by 'group'
+    expected = group_means(api, first, 'gene4', group.astype(str))
+    assert {g for d, g in got if d == first} == set(expected)
+    for g, mean in expected.items():
+        assert got[first, g][1] == pytest.approx(mean)
+
+    # without a listed column, a dataset is a single group 'all'
+    mean = api.gene(first, 'gene4').mean()
+    api.db.conn.close()
+    run(dbfile, 'db', 'meta-tables', '-g', 'cell_type')
+    got = gene_index(dbfile, 'gene4')
+    assert got[first, 'all'] == (50, pytest.approx(mean))
+
+    # the order of -g decides, not the column name
+    run(dbfile, 'db', 'meta-tables', '-g', 'group', '-g', 'cell_type')
+    got = gene_index(dbfile, 'gene4')
+    assert {g for d, g in got if d == second} == {'0', '1', '2'}
+
+    # entries are ranked by mean
+    chdb = CHDB(dbfile)
+    means = chdb.execute("""
+        SELECT list_transform(entries, e -> e.meanval)
+          FROM gene_index WHERE gene_key = 'GENE4'""").fetchone()[0]
+    assert means == sorted(means, reverse=True)
+
+
+def test_query_gene(groupdb):
+    dbfile, datasets = groupdb
+    run(dbfile, 'db', 'meta-tables', '-g', 'cell_type')
+
+    out = run(dbfile, 'q', 'gene', '-l', 'count', '-n', '3', 'GENE4')
+    lines = out.strip().splitlines()
+    assert lines[0].split()[:3] == ['dataset', 'cell_group', 'n_cells']
+    assert len(lines) == 4
+
+    api = API(dbfile, read_only=False)
+    best = max(
+        [mean for dataset_id, groups in datasets.items()
+         for mean in group_means(
+             api, dataset_id, 'gene4',
+             groups if groups is not None else np.zeros(50)).values()])
+    assert float(lines[1].split()[3]) == pytest.approx(best, rel=1e-5)
+    api.db.conn.close()
+
+    # no logrpm datasets
+    out = run(dbfile, 'q', 'gene', 'gene4', exit_code=1)
+    assert 'not found in logrpm datasets' in out
@@ -0,0 +1,110 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from cellhive.api import API
+from cellhive.db import CHDB
+from cellhive.packed import pack, packed_dtype, unpack
+
+
+def expr_rows(chdb: CHDB) -> list:
+    return chdb.execute("""
+        SELECT dataset_id, cell_id, gene_id, value
+          FROM expr ORDER BY ALL""").fetchall()
+
+
+def test_storage_mode_quoted_path(tmp_path, make_db):
+    path, dataset_id = make_db([f"gene{i}" for i in range(10)])
+    # a quote in the path of the database & its partitions
+    target = tmp_path / "it's here" / 'cellhive.duckdb'
+    target.parent.mkdir()
+    shutil.move(path, target)
+
+    chdb = CHDB(str(target))
+    before = expr_rows(chdb)
+    chdb.set_storage_mode('parquet')
+    assert chdb.storage_mode() == 'parquet'
+    assert sorted(p.name for p in chdb.expr_dir.iterdir()) \
+        == [f"dataset_id={dataset_id}"]
+    assert expr_rows(chdb) == before
+
+    chdb.copy_partition(dataset_id, """
+        SELECT cell_id, gene_id, value * 2 AS value
+          FROM expr WHERE dataset_id = ?""", [dataset_id])
+    assert [r[3] for r in expr_rows(chdb)] == [r[3] * 2 for r in before]
+    chdb.conn.close()
+
+    chdb = CHDB(str(target), read_only=True)
+    assert len(expr_rows(chdb)) == len(before)
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 1000])
+def test_pack_expr(make_db, chunksize):
+    path, dataset_id = make_db([f"gene{i}" for i in range(10)])
+    chdb = CHDB(path)
+    chdb.pack_expr([dataset_id], chunksize=chunksize)
+    rows = expr_rows(chdb)
+    dtype = packed_dtype(chdb.value_dtype(dataset_id))
+
+    for table, key, index, n_col in CHDB.PACKED_TABLES:
+        n_keys = chdb.execute(f"""
+            SELECT {n_col} FROM dataset_shape
+             WHERE dataset_id = ?""", [dataset_id]).fetchone()[0]
+        packed = chdb.execute(f"""
+            SELECT {key}, nnz, {index}s, vals FROM {table}
+             WHERE dataset_id = ? ORDER BY {key}""",
+            [dataset_id]).fetchall()
+        # every gene & cell has a row, also without entries
+        assert [row[0] for row in packed] == list(range(n_keys))
+
+        by_key = {k: [] for k in range(n_keys)}
+        for _, cell_id, gene_id, value in rows:
+            k, i = (gene_id, cell_id) if key == 'gene_id' \
+                else (cell_id, gene_id)
+            by_key[k].append((i, value))
+        for k, nnz, index_blob, value_blob in packed:
+            got = zip(*unpack(index_blob, value_blob, dtype))
+            assert nnz == len(by_key[k])
+            assert [(int(i), float(v)) for i, v in got] \
+                == sorted(by_key[k])
+
+    api = API(path, read_only=False)
+    cells, values = api.gene_nonzero(dataset_id, 'gene3')
+    assert list(zip(cells.tolist(), values.tolist())) \
+        == sorted((c, v) for _, c, g, v in rows if g == 3)
+
+
+@pytest.mark.parametrize('dtype', ['uint16', 'uint32', 'float32'])
+def test_pack_roundtrip(dtype):
+    index = np.array([0, 1, 5, 6, 100_000, 2**31 - 1], dtype=np.int64)
+    values = np.array([1, 2, 3, 65535, 0.5, 7]).astype(dtype)
+    got_index, got_values = unpack(*pack(index, values, dtype), dtype)
+    assert got_index.dtype == np.int32 and got_values.dtype == dtype
+    assert (got_index == index).all() and (got_values == values).all()
+
+    empty = unpack(*pack(index[:0], values[:0], dtype), dtype)
+    assert len(empty[0]) == len(empty[1]) == 0
+
+
+def test_stream_moved_parquet_db(tmp_path, make_db):
+    path, dataset_id = make_db([f"gene{i}" for i in range(10)])
+    chdb = CHDB(path)
+    chdb.set_storage_mode('parquet')
+    before = expr_rows(chdb)
+    expr_dir = chdb.expr_dir
+    chdb.conn.close()
+
+    # the stored expr view points at the old location
+    moved = tmp_path / 'moved'
+    moved.mkdir()
+    shutil.move(path, moved / 'cellhive.duckdb')
+    shutil.move(expr_dir, moved / 'cellhive.expr')
+
+    chdb = CHDB(str(moved / 'cellhive.duckdb'), read_only=True)
+    batches = chdb.stream("""
+        SELECT dataset_id, cell_id, gene_id, value
+          FROM expr ORDER BY ALL""", batch_size=7)
+    rows = [row for batch in batches
+            for row in zip(*(c.to_pylist() for c in batch.columns))]
+    assert rows == before
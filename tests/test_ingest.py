@@ -0,0 +1,281 @@
+"""Streaming nonzero entries from matrices & the upload paths."""
+
+import numpy as np
+import pytest
+import scipy.sparse
+
+from cellhive.db import CHDB
+from cellhive.ingest import (H5Sparse, indptr_ranges, iter_nonzero,
+                             matrix_stats)
+
+CHUNKSIZES = [1, 3, 7, 1000]
+
+
+def random_matrix(n_rows: int = 20, n_cols: int = 9) -> np.ndarray:
+    """A dense matrix with about a third nonzero entries."""
+    rng = np.random.default_rng(0)
+    X = rng.integers(1, 10, size=(n_rows, n_cols)).astype(np.float32)
+    X[rng.random((n_rows, n_cols)) < 0.7] = 0
+    return X
+
+
+def as_kind(X: np.ndarray, kind: str):
+    """X as a dense array or a scipy sparse matrix of this format."""
+    if kind == 'dense':
+        return X
+    return scipy.sparse.coo_matrix(X).asformat(kind)
+
+
+def triples(chunks) -> set:
+    """Collect the (row, col, value) entries of `iter_nonzero` chunks."""
+    rv = set()
+    for rows, cols, values in chunks:
+        assert len(rows) == len(cols) == len(values)
+        rv.update(zip(rows.tolist(), cols.tolist(), values.tolist()))
+    return rv
+
+
+def expected(X: np.ndarray, start: int = 0, stop=None, axis: int = 0):
+    """The nonzero entries of X with major index in [start, stop)."""
+    rows, cols = np.nonzero(X)
+    major = rows if axis == 0 else cols
+    stop = X.shape[axis] if stop is None else stop
+    keep = (major >= start) & (major < stop)
+    rows, cols = rows[keep], cols[keep]
+    return set(zip(rows.tolist(), cols.tolist(), X[rows, cols].tolist()))
+
+
+@pytest.fixture
+def h5matrices(tmp_path):
+    """The same matrix as CSR, CSC & dense datasets in an h5ad file."""
+    import anndata as ad
+    import h5py
+
+    X = random_matrix()
+    adata = ad.AnnData(X=scipy.sparse.csr_matrix(X))
+    adata.layers['csc'] = scipy.sparse.csc_matrix(X)
+    adata.layers['dense'] = X
+    path = tmp_path / 'matrix.h5ad'
+    adata.write_h5ad(path)
+    with h5py.File(path, 'r') as h5file:
+        yield X, h5file
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+@pytest.mark.parametrize('kind', ['csr', 'csc', 'coo', 'dense'])
+def test_iter_nonzero(kind, chunksize):
+    X = random_matrix()
+    matrix = as_kind(X, kind)
+    assert triples(iter_nonzero(matrix, chunksize)) == expected(X)
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+def test_iter_nonzero_h5(h5matrices, chunksize):
+    X, h5file = h5matrices
+    for matrix in (H5Sparse(h5file['X']), H5Sparse(h5file['layers/csc']),
+                   h5file['layers/dense']):
+        assert triples(iter_nonzero(matrix, chunksize)) == expected(X)
+
+
+def test_iter_nonzero_chunksize():
+    X = random_matrix()
+    per_row = np.count_nonzero(X, axis=1)
+    for chunksize in CHUNKSIZES:
+        for _, _, values in iter_nonzero(scipy.sparse.csr_matrix(X),
+                                         chunksize):
+            # a chunk only grows beyond chunksize for a single large row
+            assert len(values) <= max(chunksize, per_row.max())
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+@pytest.mark.parametrize('kind, axis', [('csr', 0), ('csc', 1),
+                                        ('dense', 0)])
+def test_iter_nonzero_range(kind, axis, chunksize):
+    X = random_matrix()
+    matrix = as_kind(X, kind)
+    got = triples(iter_nonzero(matrix, chunksize, start=2, stop=7))
+    assert got == expected(X, 2, 7, axis=axis)
+
+
+def test_iter_nonzero_explicit_zeros():
+    X = random_matrix()
+    matrix = scipy.sparse.csr_matrix(X)
+    matrix.data[::2] = 0
+    assert matrix.nnz > np.count_nonzero(matrix.data)
+    for chunksize in CHUNKSIZES:
+        got = triples(iter_nonzero(matrix, chunksize))
+        assert got == expected(matrix.toarray())
+        assert all(value != 0 for _, _, value in got)
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+def test_matrix_stats(chunksize):
+    X = random_matrix()
+    stats = matrix_stats(scipy.sparse.csr_matrix(X), chunksize)
+    assert stats == dict(min=0, max=X.max(), nnz=np.count_nonzero(X),
+                         entries=X.size)
+
+    full = np.ones((3, 4))
+    assert matrix_stats(full, chunksize)['min'] == 1
+
+    first = matrix_stats(X, chunksize, fingerprint=True)['fingerprint']
+    assert matrix_stats(X, chunksize, fingerprint=True)['fingerprint'] \
+        == first
+    X[0, 0] += 1
+    assert matrix_stats(X, chunksize, fingerprint=True)['fingerprint'] \
+        != first
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+def test_indptr_ranges(chunksize):
+    indptr = scipy.sparse.csr_matrix(random_matrix()).indptr
+    ranges = indptr_ranges(indptr, chunksize)
+
+    # contiguous & covering all rows
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(indptr) - 1
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    for start, stop in ranges:
+        assert stop > start
+        size = indptr[stop] - indptr[start]
+        assert size <= chunksize or stop == start + 1
+
+
+def test_indptr_ranges_empty():
+    assert indptr_ranges(np.array([0]), 10) == []
+    assert indptr_ranges(np.zeros(4, dtype=int), 10) == [(0, 3)]
+
+
+def stored(chdb: CHDB, dataset_id: int) -> set:
+    """The (cell, gene, value) entries stored for a dataset."""
+    rv = chdb.execute("""
+        SELECT cell_id, gene_id, value FROM expr
+         WHERE dataset_id = ?""", [dataset_id]).fetchall()
+    return set(rv)
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+@pytest.mark.parametrize('kind', ['csr', 'csc', 'dense'])
+def test_import_count_table(make_db, kind, chunksize):
+    import anndata as ad
+
+    path, dataset_id = make_db([f"gene{i}" for i in range(9)])
+    X = random_matrix()
+    matrix = as_kind(X, kind)
+
+    chdb = CHDB(path)
+    chdb.import_count_table(dataset_id, ad.AnnData(X=matrix), 'X',
+                            chunksize=chunksize)
+    assert stored(chdb, dataset_id) == expected(X)
+
+
+def upload(dbfile: str, *args: str, exit_code: int = 0) -> None:
+    """Run `ch upload` on a database."""
+    from click.testing import CliRunner
+
+    from cellhive.cli import cli
+
+    result = CliRunner().invoke(cli, ['--db', dbfile, 'upload', *args],
+                                catch_exceptions=False)
+    assert result.exit_code == exit_code, result.output
+
+
+def uploaded(dbfile: str) -> dict:
+    """The stored entries of each layer, by layer name."""
+    # the upload's own (read-write) connection may still be open
+    chdb = CHDB(dbfile)
+    layers = chdb.execute("""
+        SELECT layer_name, dataset_id FROM experiment_md""").fetchall()
+    return {name: stored(chdb, dataset_id) for name, dataset_id in layers}
+
+
+@pytest.mark.parametrize('fmt', ['csr', 'csc'])
+def test_upload_paths(tmp_path, make_h5ad, fmt):
+    import anndata as ad
+
+    h5ad = make_h5ad(fmt=fmt)
+    adata = ad.read_h5ad(h5ad)
+    matrices = dict(X=adata.X, logrpm=adata.layers['logrpm'],
+                    RAW=adata.raw.X)
+
+    results = []
+    for args in (['-b'], ['-j', '2'], ['-b', '--max-memory', '1MB']):
+        dbfile = str(tmp_path / f"{'_'.join(args)}.duckdb")
+        CHDB(dbfile).conn.close()
+        upload(dbfile, *args, h5ad)
+        results.append(uploaded(dbfile))
+
+    assert all(rv == results[0] for rv in results)
+    for layer, matrix in matrices.items():
+        X = np.asarray(matrix.toarray(), dtype=np.float32)
+        assert results[0][layer] == expected(X)
+
+
+def test_upload_in_memory(tmp_path, make_h5ad):
+    pytest.importorskip('scanpy')
+
+    h5ad = make_h5ad()
+    results = []
+    for args in ([], ['-b']):
+        dbfile = str(tmp_path / f"{len(args)}.duckdb")
+        CHDB(dbfile).conn.close()
+        upload(dbfile, *args, h5ad)
+        results.append(uploaded(dbfile))
+    assert results[0] == results[1]
+
+
+def test_prepare_closes_file_on_error(make_h5ad, monkeypatch):
+    from cellhive import ingest
+    from cellhive import metadata_tools as mdtools
+    from cellhive.cli_db_upload import prepare_h5ad
+
+    opened = []
+
+    def open_h5ad(path):
+        adata, h5file = ingest_open_h5ad(path)
+        opened.append(h5file)
+        return adata, h5file
+
+    def layers(*args, **kwargs):
+        raise ValueError("broken layer")
+
+    ingest_open_h5ad = ingest.open_h5ad
+    monkeypatch.setattr(ingest, 'open_h5ad', open_h5ad)
+    monkeypatch.setattr(mdtools, 'layers', layers)
+    with pytest.raises(ValueError):
+        prepare_h5ad(make_h5ad(), backed=True)
+    assert len(opened) == 1 and not opened[0].id.valid
+
+
+def test_upload_missing_manifest_entry(tmp_path, make_h5ad):
+    h5ad = make_h5ad()
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text(f"missing.h5ad\n{h5ad}\n")
+    dbfile = str(tmp_path / 'cellhive.duckdb')
+    CHDB(dbfile).conn.close()
+
+    upload(dbfile, '-b', str(manifest), exit_code=1)
+
+    chdb = CHDB(dbfile)
+    jobs = dict(chdb.execute("""
+        SELECT path, status FROM upload_job""").fetchall())
+    assert jobs == {str(tmp_path / 'missing.h5ad'): 'failed',
+                    str(tmp_path / 'one.h5ad'): 'done'}
+
+
+def test_upload_drops_old_expr(tmp_path, make_h5ad):
+    dbfile = str(tmp_path / 'cellhive.duckdb')
+    chdb = CHDB(dbfile)
+    chdb.execute("""
+        CREATE TABLE expr (obs VARCHAR, gene VARCHAR, value FLOAT,
+                           dataset_id INTEGER)""")
+    chdb.execute("INSERT INTO expr VALUES ('cell0', 'gene0', 1, 0)")
+    chdb.set_fingerprint('layer/0', 'old')
+    chdb.conn.close()
+
+    upload(dbfile, '-b', make_h5ad())
+
+    chdb = CHDB(dbfile)
+    cols = chdb.sql("DESCRIBE expr")['column_name']
+    assert 'obs' not in set(cols)
+    assert chdb.get_fingerprint('layer/0') != 'old'
+    assert all(uploaded(dbfile).values())